@@ -0,0 +1,137 @@
+from typing import Any
+
+from expr import Expr, Op
+from interpret import FunValue, Interpret, Ty, TypeMismatch, Value
+from utils import Span, Spanned
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
+
+# Arithmetic whose operands are at least this large might not fit in an int64, so it's done
+# on Python ints instead
+LIMIT = 2**63
+
+# An `int64` array, or an `object` array of Python ints once something might overflow
+Array = Any
+BatchValue = Value | Array
+
+
+class Fallback(Exception):
+    # Raised when evaluating lanes together wouldn't do exactly what evaluating them one at a
+    # time does, so `apply` does that instead
+    pass
+
+
+def bound(value: int | Array) -> int:
+    # The largest magnitude in `value`, as a Python int so it can't overflow
+    if isinstance(value, int):
+        return abs(value)
+    if value.dtype == object or value.size == 0:
+        return 0
+    return max(-int(value.min()), int(value.max()))
+
+
+def widen(value: int | Array, needed: int) -> int | Array:
+    if needed < LIMIT or isinstance(value, int) or value.dtype == object:
+        return value
+    return value.astype(object)
+
+
+class BatchInterpret(Interpret):
+    """
+    An `Interpret` where integers can also be arrays, one element for each of a batch of
+    arguments (or lanes), with arithmetic on them done by NumPy a whole array at a time
+
+    Note: There are no conditionals, so which nodes get evaluated, and whether they make
+    functions or integers, is the same for every lane. Only the integers differ, so a batch
+    of lanes can share one evaluation. Arithmetic that might overflow an int64 is done on
+    arrays of Python ints instead, and anything that can happen in some lanes and not others
+    (dividing by zero) or that's visible in between them (printing) raises `Fallback`
+    """
+
+    def negate(self, span: Span, expr: Expr) -> BatchValue:
+        value = self.interpret(expr)
+        if isinstance(value, FunValue):
+            raise TypeMismatch(span=span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+        return -widen(value, bound(value))
+
+    def bin_op(self, span: Span, op: Spanned[Op], lhs: Expr, rhs: Expr) -> BatchValue:
+        x = self.interpret(lhs)
+        y = self.interpret(rhs)
+
+        match (isinstance(x, FunValue), isinstance(y, FunValue)):
+            case (False, True):
+                raise TypeMismatch(span=rhs.span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+            case (True, False):
+                raise TypeMismatch(span=lhs.span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+            case (True, True):
+                raise TypeMismatch(span=span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+
+        match op.data:
+            case Op.OP_ADD | Op.OP_SUB:
+                needed = bound(x) + bound(y)
+            case Op.OP_MUL:
+                needed = bound(x) * bound(y)
+            case Op.OP_DIV | Op.OP_MOD:
+                if isinstance(y, int) and y == 0 or not isinstance(y, int) and not y.all():
+                    raise Fallback()
+                # Only `-2**63 // -1` overflows, but a divisor that isn't an int64 can't be
+                # divided by either
+                needed = max(bound(x), bound(y))
+        x, y = widen(x, needed), widen(y, needed)
+
+        match op.data:
+            case Op.OP_ADD:
+                return x + y
+            case Op.OP_SUB:
+                return x - y
+            case Op.OP_MUL:
+                return x * y
+            case Op.OP_DIV:
+                return x // y
+            case Op.OP_MOD:
+                return x % y
+
+        assert False, "unreachable"
+
+    def printt(self, expr: Expr) -> Value:
+        raise Fallback()
+
+
+def lanes(args: list[int]) -> Array:
+    try:
+        return np.array(args, dtype=np.int64)
+    except OverflowError:
+        return np.array(args, dtype=object)
+
+
+def apply(f: FunValue, args: list[int]) -> list[Value]:
+    """
+    Applies `f` to each of `args`, giving exactly what `Interpret(None).call(f, arg)` would for
+    each of them (raising what it would for the first that raises), but with the arithmetic
+    for all of them done at once by `BatchInterpret`
+
+    Note: Falls back to calling `f` on each argument in turn when that's the only way to give
+    the same results, such as when `f` prints or returns a function
+    """
+
+    if np is None:
+        raise ImportError("Batch evaluation needs NumPy")
+    if not args:
+        return []
+
+    try:
+        result = BatchInterpret(None).call(f, lanes(args))
+    except (Fallback, OverflowError):
+        # An `OverflowError` is NumPy failing to fit a Python int into an int64 somewhere the
+        # bounds didn't account for
+        result = None
+    match result:
+        case int():
+            return [result] * len(args)
+        case FunValue() | None:
+            interpret = Interpret(None)
+            return [interpret.call(f, arg) for arg in args]
+    return result.tolist()  # type: ignore
@@ -0,0 +1,1218 @@
+import argparse
+import contextlib
+import functools
+import gc
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, fields, make_dataclass
+from typing import Callable, Optional
+
+import batch
+import cache
+import cek
+import closure
+import incremental
+import inline
+import main
+import memo
+import optimize
+import serialize
+import typecheck
+import vm
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Node,
+    Print,
+    RawLetBind,
+    count_nodes,
+)
+from interpret import Env, Interpret, LimitedInterpret, Limits, Value
+from lexer import FastLexer, Lexer, MappedSource, tokenize
+from parser import Parser
+from profiler import Profiler
+from resolve import resolve
+from tracing import DebugTracer, Tracer, TracingInterpret
+from utils import Span, Spanned
+
+
+class CountingInterpret(Interpret):
+    calls: int = 0
+
+    def app(self, f: Expr, arg: Expr) -> Value:
+        self.calls += 1
+        return super().app(f, arg)
+
+
+class DictEnv:
+    # The mutable dict-per-frame environment that `Env` replaced, for `bench_env`
+    enclosing: "Optional[DictEnv]"
+    bindings: dict[str, Spanned[Value]]
+
+    def __init__(self, enclosing: "Optional[DictEnv]"):
+        self.enclosing = enclosing
+        self.bindings = {}
+
+    def __getitem__(self, ident: str) -> Optional[Spanned[Value]]:
+        env: Optional[DictEnv] = self
+        while env is not None:
+            if (value := env.bindings.get(ident, None)) is not None:
+                return value
+            env = env.enclosing
+        return None
+
+    def extend(self, ident: Spanned[str], value: Value) -> "DictEnv":
+        env = DictEnv(self)
+        env.bindings[ident.data] = ident.map_data(lambda _: value)
+        return env
+
+
+@dataclass
+class OldSpan:
+    start: int
+    end: int
+
+
+@dataclass
+class OldSpanned:
+    span: OldSpan
+    data: object
+
+
+# The plain dataclasses nodes were before `expr.py` moved their spans inline, for
+# `bench_ast`. Each one was wrapped in a `Spanned` with its own `Span`
+INLINE_FIELDS = ("start", "end", "slot")
+OLD_NODES = {
+    kind: make_dataclass(
+        f"Old{kind.__name__}",
+        [field.name for field in fields(kind) if field.name not in INLINE_FIELDS],
+    )
+    for kind in [RawLetBind, LetIn, Fun, App, Negate, BinOp, Print, Ident, IntLit]
+}
+
+
+def old_layout(node: Node) -> OldSpanned:
+    # `node` as it used to be stored, copying names since the parser didn't intern them
+    values = {}
+    for name in OLD_NODES[type(node)].__dataclass_fields__:
+        value = getattr(node, name)
+        match value:
+            case Node():
+                value = old_layout(value)
+            case list():
+                value = [old_layout(bind) for bind in value]
+            case Spanned(span, data):
+                data = "".join(data) if isinstance(data, str) else data
+                value = OldSpanned(OldSpan(span.start, span.end), data)
+            case str():
+                value = "".join(value)
+        values[name] = value
+    return OldSpanned(OldSpan(node.start, node.end), OLD_NODES[type(node)](**values))
+
+
+PRELUDE = """let add = fun a b   => a + b,
+    sub = fun a b   => b - a,
+    cmp = fun f g x => g (f x)
+in
+"""
+
+
+def curried_program(depth: int) -> str:
+    # Every level composes the previous one with itself, so `depth` levels make 2^depth calls
+    lets = ["f0 = cmp (add 1) (sub 1)"]
+    for i in range(1, depth):
+        lets.append(f"f{i} = cmp f{i - 1} f{i - 1}")
+    return f"{PRELUDE}let {', '.join(lets)} in f{depth - 1} 123"
+
+
+def measure(name: str, f: Callable[[], object], number: int) -> float:
+    seconds = min(timeit.repeat(f, number=number, repeat=5)) / number
+    print(f"{name: <24} {seconds * 1000:10.3f} ms")
+    return seconds
+
+
+def nested_scopes_program(depth: int, uses: int) -> str:
+    # `x0` is bound `depth` scopes out from where it's used
+    lets = "".join(f"let x{i} = {i} in " for i in range(depth))
+    return f"{lets}let f = fun n => {' + '.join(['x0'] * uses)} in f 1"
+
+
+def numeral_program(n: int, tail: bool) -> str:
+    # Church numeral `n` applied to `inc`, with `succ` calling its predecessor in tail
+    # position or not, so the call depth is `n` either way
+    succ = "n f (f x)" if tail else "f (n f x)"
+    numerals = ", ".join(f"n{i} = succ n{i - 1}" for i in range(1, n + 1))
+    return (
+        f"let zero = fun f x => x, succ = fun n f x => {succ}, inc = fun n => n + 1, "
+        f"n0 = zero, {numerals} in n{n} inc 0"
+    )
+
+
+def sum_program(n: int) -> str:
+    # Parses into a left-leaning `BinOp` tree `n` levels deep
+    return " + ".join(["1"] * n)
+
+
+def let_chain_program(n: int) -> str:
+    lets = ", ".join(f"x{i} = x{i - 1} + 1" for i in range(1, n + 1))
+    return f"let x0 = 0, {lets} in x{n}"
+
+
+def wide_program(size: int) -> str:
+    # One long `let` with bindings in the style of `test.txt`, roughly `size` bytes
+    lets = ["x0 = 0"]
+    length = 0
+    while length < size:
+        i = len(lets)
+        lets.append(f"x{i} = (fun a b => b - a) (x{i - 1} * 2) ({i} + x{i - 1} % 7)")
+        length += len(lets[-1]) + 2
+    return f"let {', '.join(lets)} in x{len(lets) - 1}"
+
+
+def wide_program_result(size: int) -> int:
+    # What `wide_program(size)` evaluates to, remembering that operators have no precedence
+    x = 0
+    for i in range(1, wide_program(size).count(" => ") + 1):
+        x = (i + x) % 7 - x * 2
+    return x
+
+
+def nested_program(size: int) -> str:
+    # Nested parentheses and `let`s, roughly `size` bytes and about `size / 12` deep
+    depth = max(1, size // 12)
+    return "(let y = " * depth + "1" + " in y)" * depth
+
+
+def bench_closure(args: argparse.Namespace):
+    for depth in args.depths:
+        expr = Parser(curried_program(depth)).parse_expr()
+        print(f"curried composition, depth {depth} ({2 ** depth} calls)")
+        tree = measure(
+            "interpret", lambda: Interpret(None).interpret(expr), args.number
+        )
+        compiled = measure("closure", lambda: closure.evaluate(expr), args.number)
+        code = closure.Compiler().compile(resolve(expr))
+        precompiled = measure(
+            "closure (precompiled)", lambda: code([None]), args.number
+        )
+        print(
+            f"speedup: {tree / compiled:.2f}x, {tree / precompiled:.2f}x precompiled\n"
+        )
+
+
+def bench_vm(args: argparse.Namespace):
+    for depth in args.depths:
+        expr = Parser(curried_program(depth)).parse_expr()
+        print(f"curried composition, depth {depth} ({2 ** depth} calls)")
+        tree = measure(
+            "interpret", lambda: Interpret(None).interpret(expr), args.number
+        )
+        code = closure.Compiler().compile(resolve(expr))
+        closures = measure("closure (precompiled)", lambda: code([None]), args.number)
+        chunk = vm.compile_program(expr)
+        bytecode = measure(
+            "vm (precompiled)", lambda: vm.execute(chunk, [None]), args.number
+        )
+        print(
+            f"vm speedup: {tree / bytecode:.2f}x over interpret, "
+            f"{closures / bytecode:.2f}x over closure\n"
+        )
+
+
+def bench_depth(args: argparse.Namespace):
+    workloads = [
+        ("tail calls", lambda n: numeral_program(n, tail=True)),
+        ("non-tail calls", lambda n: numeral_program(n, tail=False)),
+        ("nested BinOp", sum_program),
+        ("let chain", let_chain_program),
+    ]
+    engines = [
+        ("interpret", lambda expr: Interpret(None).interpret(expr)),
+        ("cek", cek.evaluate),
+    ]
+
+    print(
+        f"{'workload': <16} {'depth': >8} {'engine': <10} {'time': >14} {'peak': >14}"
+    )
+    for name, program in workloads:
+        for depth in args.depths:
+            expr = Parser(program(depth)).parse_expr()
+            for engine, evaluate in engines:
+                tracemalloc.start()
+                start = time.perf_counter()
+                try:
+                    evaluate(expr)
+                    elapsed = f"{(time.perf_counter() - start) * 1000:9.3f} ms"
+                    peak = f"{tracemalloc.get_traced_memory()[1] / 1024:9.1f} KiB"
+                except RecursionError:
+                    elapsed = peak = "RecursionError"
+                finally:
+                    tracemalloc.stop()
+                print(
+                    f"{name: <16} {depth: >8} {engine: <10} {elapsed: >14} {peak: >14}"
+                )
+
+
+def bench_inline(args: argparse.Namespace):
+    for depth in args.depths:
+        expr = Parser(curried_program(depth)).parse_expr()
+        inlined = inline.inline(expr, args.budget)
+        print(
+            f"curried composition, depth {depth}: "
+            f"{count_nodes(expr)} -> {count_nodes(inlined)} nodes"
+        )
+        for name, program in [("original", expr), ("inlined", inlined)]:
+            counter = CountingInterpret(None)
+            result = counter.interpret(program)
+            print(f"{name: <24} {counter.calls: >10} applications = {result}")
+
+        before = measure(
+            "interpret", lambda: Interpret(None).interpret(expr), args.number
+        )
+        after = measure(
+            "interpret (inlined)",
+            lambda: Interpret(None).interpret(inlined),
+            args.number,
+        )
+        chunk, inlined_chunk = vm.compile_program(expr), vm.compile_program(inlined)
+        vm_before = measure("vm", lambda: vm.execute(chunk, [None]), args.number)
+        vm_after = measure(
+            "vm (inlined)", lambda: vm.execute(inlined_chunk, [None]), args.number
+        )
+        print(
+            f"speedup: {before / after:.2f}x interpret, "
+            f"{vm_before / vm_after:.2f}x vm\n"
+        )
+
+    check_errors("by inlining", lambda expr: inline.inline(expr, args.budget))
+
+
+# Programs that raise, where a node that a pass replaces is one an error is reported at
+ERROR_PROGRAMS = [
+    "(let a = 1 in 2) 5",
+    "(let a = 1 in b) 5",
+    "let a = 1 in b",
+    "(let a = 1 in (fun x => x) + (fun y => y)) 1",
+    "(let a = 1 in fun x => x) + 1",
+    "(x + 0) 1",
+    "let x = 5 in ((x + 1) * 1) 2",
+    "let x = 5 in (1 * (x - 1)) 2",
+    "(let y = 2 in 0 + (y * 1)) 3",
+    "(((fun x => x) * (fun y => y)) * 1) 3",
+    "((fun q => q + 3) 2) (fun z => z)",
+    "let f = fun x => x 1 in f 2",
+    "let g = fun x => x + 1 in (g 1) 2",
+    "let id = fun x => x in id 1 2",
+    "let k = fun x y => x in (k 1 2) 3",
+    "let f = fun x => x + 0 in f (fun y => y)",
+    "let b = fun a => b - 0 in (b 0) 1",
+    "1 / (0 * 1)",
+]
+
+
+def outcome(expr: Expr) -> str:
+    # What evaluating `expr` printed, then what it returned or the error it raised
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            value = Interpret(None).interpret(expr)
+            result = str(value) if isinstance(value, int) else "<function value>"
+        except Exception as exp:
+            result = repr(exp)
+    return output.getvalue() + result
+
+
+def check_errors(name: str, transform: Callable[[Expr], Expr]):
+    # A pass shouldn't change what a program does, including where it reports errors
+    for source in ERROR_PROGRAMS:
+        expr = Parser(source).parse_expr()
+        expected = outcome(expr)
+        got = outcome(transform(Parser(source).parse_expr()))
+        assert got == expected, f"{source!r}: expected {expected}, got {got} {name}"
+    print(f"Errors and spans unchanged {name} on {len(ERROR_PROGRAMS)} programs")
+
+
+def identities_program(n: int) -> str:
+    # `n` bindings nobody uses, and a function full of identities applied `n` times
+    lets = "".join(f"d{i} = fun x => x, " for i in range(n))
+    return f"let {lets}f = fun x => (x + 1 - 1) * 1 + 0 in {'f (' * n}0{')' * n}"
+
+
+def bench_optimize(args: argparse.Namespace):
+    workloads = [("sum of ones", sum_program), ("identities", identities_program)]
+    for workload, program in workloads:
+        for size in args.sizes:
+            expr = Parser(program(size)).parse_expr()
+            optimized, removed = optimize.optimize(expr)
+            nodes = count_nodes(expr)
+            print(f"{workload}, size {size}: {removed} of {nodes} nodes removed")
+            before = measure(
+                "interpret", lambda: Interpret(None).interpret(expr), args.number
+            )
+            after = measure(
+                "interpret (optimized)",
+                lambda: Interpret(None).interpret(optimized),
+                args.number,
+            )
+            print(f"speedup: {before / after:.2f}x\n")
+
+    check_errors("by optimizing", lambda expr: optimize.optimize(expr)[0])
+
+
+def closures_program(n: int) -> str:
+    # `n` closures that are all still alive when the body runs
+    lets = ", ".join(f"c{i} = mk {i}" for i in range(n))
+    return f"let mk = fun n => fun x => n + x, {lets} in (c0 1) + (c{n - 1} 1)"
+
+
+def allocations(f: Callable[[], object], number: int) -> tuple[float, float]:
+    # The bytes and memory blocks each call to `f` allocates for what it returns
+    results = [None] * number
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(number):
+        results[i] = f()  # type: ignore
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+    stats = after.compare_to(before, "lineno")
+    size = sum(stat.size_diff for stat in stats)
+    count = sum(stat.count_diff for stat in stats)
+    return size / number, count / number
+
+
+def bench_env(args: argparse.Namespace):
+    workloads = [
+        ("church numerals", lambda n: numeral_program(n, tail=True)),
+        ("live closures", closures_program),
+        ("curried composition", lambda n: curried_program(n.bit_length())),
+    ]
+    envs: list[tuple[str, Callable[[], Env]]] = [
+        ("DictEnv", lambda: DictEnv(None)),  # type: ignore
+        ("Env", Env),
+    ]
+
+    # A `let` extends the environment it's in, a call the one its function captured
+    name = Spanned(Span(0, 1), "x")
+    print(
+        f"{'env': <8} {'let allocations': >16} {'let bytes': >10} "
+        f"{'call allocations': >17} {'call bytes': >11}"
+    )
+    for env_name, empty in envs:
+        env = [empty()]
+
+        def let() -> object:
+            env[0] = env[0].extend(name, 1)
+            return env[0]
+
+        captures = empty()
+        let_bytes, let_blocks = allocations(let, args.bindings)
+        call_bytes, call_blocks = allocations(
+            lambda: captures.extend(name, 1), args.bindings
+        )
+        print(
+            f"{env_name: <8} {let_blocks:16.1f} {let_bytes:10.1f} "
+            f"{call_blocks:17.1f} {call_bytes:11.1f}"
+        )
+
+    print(f"\n{'workload': <20} {'size': >6} {'env': <8} {'time': >12} {'peak': >12}")
+    for workload, program in workloads:
+        for size in args.sizes:
+            expr = Parser(program(size)).parse_expr()
+            for env_name, empty in envs:
+                seconds = min(
+                    timeit.repeat(
+                        lambda: Interpret(empty()).interpret(expr),
+                        number=args.number,
+                        repeat=5,
+                    )
+                )
+                _, peak = traced_peak(lambda: Interpret(empty()).interpret(expr))
+                print(
+                    f"{workload: <20} {size: >6} {env_name: <8} "
+                    f"{seconds / args.number * 1000:9.3f} ms {peak / 1024:8.1f} KiB"
+                )
+
+
+def bench_lex(args: argparse.Namespace):
+    print(
+        f"{'lexer': <10} {'bytes': >10} {'tokens': >10} {'time': >12} {'tokens/s': >14}"
+    )
+    for size in args.sizes:
+        source = wide_program(size)
+        for name, lexer in [("Lexer", Lexer), ("FastLexer", FastLexer)]:
+            start = time.perf_counter()
+            count = sum(1 for _ in lexer(source))
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name: <10} {len(source): >10} {count: >10} "
+                f"{elapsed * 1000:9.1f} ms {count / elapsed: >14,.0f}"
+            )
+
+
+def traced_peak(f: Callable[[], object]) -> tuple[object, int]:
+    tracemalloc.start()
+    try:
+        # Keep the result alive until the peak has been read
+        result = f()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_tokens(args: argparse.Namespace):
+    for size in args.sizes:
+        source = wide_program(size)
+        tokens, objects = traced_peak(lambda: list(FastLexer(source)))
+        count = len(tokens)
+        del tokens
+        _, arrays = traced_peak(lambda: tokenize(source))
+        print(f"{len(source)} bytes of source, {count} tokens")
+        print(f"{'Token objects': <16} {objects / count:8.1f} bytes/token")
+        print(f"{'TokenArrays': <16} {arrays / count:8.1f} bytes/token")
+
+        streamed = measure(
+            "parse (stream)", lambda: Parser(source).parse_expr(), args.number
+        )
+        compact = measure(
+            "parse (compact)",
+            lambda: Parser(source, compact=True).parse_expr(),
+            args.number,
+        )
+        print(f"compact parse: {streamed / compact:.2f}x\n")
+
+
+def bench_ast(args: argparse.Namespace):
+    for size in args.sizes:
+        source = wide_program(size)
+        tracemalloc.start()
+        expr = Parser(source, compact=True).parse_expr()
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        tracemalloc.start()
+        old = old_layout(expr)
+        old_retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del old
+        nodes = count_nodes(expr)
+        print(
+            f"{len(source)} bytes of source, {nodes} nodes: "
+            f"{old_retained / nodes:.1f} -> {retained / nodes:.1f} bytes/node "
+            f"({old_retained / 1024 / 1024:.1f} -> {retained / 1024 / 1024:.1f} MiB)"
+        )
+
+    # The representation of the tree shouldn't change what it evaluates to
+    checks = [
+        (let_chain_program(200), 200),
+        (numeral_program(50, tail=True), 50),
+        (curried_program(6), 123),
+        (wide_program(2_000), wide_program_result(2_000)),
+    ]
+    for source, expected in checks:
+        with contextlib.redirect_stdout(io.StringIO()):
+            got = Interpret(None).interpret(Parser(source).parse_expr())
+        assert got == expected, f"expected {expected}, got {got}"
+    print(f"Interpret results unchanged on {len(checks)} programs")
+
+
+def bench_parse(args: argparse.Namespace):
+    print(f"{'workload': <10} {'bytes': >10} {'time': >12} {'throughput': >14}")
+    for name, program in [("wide", wide_program), ("nested", nested_program)]:
+        for size in args.sizes:
+            source = program(size)
+            start = time.perf_counter()
+            Parser(source).parse_expr()
+            elapsed = time.perf_counter() - start
+            throughput = len(source) / elapsed / 1024 / 1024
+            print(
+                f"{name: <10} {len(source): >10} {elapsed * 1000:9.1f} ms "
+                f"{throughput:9.3f} MiB/s"
+            )
+
+
+def bench_cache(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            source = wide_program(size)
+            print(f"wide program, {len(source)} bytes")
+            parse = measure("parse", lambda: Parser(source).parse_expr(), args.number)
+            cache.ParseCache(directory=directory).parse(source)
+            disk = measure(
+                "disk cache hit",
+                lambda: cache.ParseCache(directory=directory).parse(source),
+                args.number,
+            )
+            in_memory = cache.ParseCache()
+            in_memory.parse(source)
+            memory = measure(
+                "memory cache hit", lambda: in_memory.parse(source), args.number
+            )
+            print(f"speedup: {parse / disk:.2f}x disk, {parse / memory:.2f}x memory\n")
+
+
+def bench_serialize(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "program.ast")
+        for size in args.sizes:
+            source = wide_program(size)
+            expr = Parser(source).parse_expr()
+            serialize.dump(expr, path)
+            pickled = pickle.dumps(expr, protocol=pickle.HIGHEST_PROTOCOL)
+            print(
+                f"wide program: {len(source)} bytes of source, "
+                f"{os.path.getsize(path)} as an .ast, {len(pickled)} pickled"
+            )
+            parse = measure("parse", lambda: Parser(source).parse_expr(), args.number)
+            load = measure("load (mmap)", lambda: serialize.load(path), args.number)
+            unpickle = measure(
+                "pickle.loads", lambda: pickle.loads(pickled), args.number
+            )
+            print(
+                f"load speedup: {parse / load:.2f}x over parsing, "
+                f"{unpickle / load:.2f}x over unpickling\n"
+            )
+
+
+def bench_lookup(args: argparse.Namespace):
+    for depth in args.depths:
+        expr = Parser(nested_scopes_program(depth, args.uses)).parse_expr()
+        print(f"variable bound {depth} scopes out, used {args.uses} times")
+        by_name = measure(
+            "Env (by name)", lambda: Interpret(None).interpret(expr), args.number
+        )
+        code = closure.Compiler().compile(resolve(expr))
+        by_address = measure("Frame (depth, slot)", lambda: code([None]), args.number)
+        print(f"speedup: {by_name / by_address:.2f}x\n")
+
+
+def bench_trace(args: argparse.Namespace):
+    tracers: list[tuple[str, Callable[[], Interpret]]] = [
+        ("tracing off", lambda: Interpret(None)),
+        ("Tracer", lambda: TracingInterpret(None, Tracer())),
+        ("DebugTracer", lambda: TracingInterpret(None, DebugTracer())),
+        ("Profiler", lambda: TracingInterpret(None, Profiler())),
+    ]
+    workloads = [
+        ("curried composition", curried_program),
+        ("live closures", lambda n: closures_program(2**n)),
+    ]
+    for workload, program in workloads:
+        for depth in args.depths:
+            expr = Parser(program(depth)).parse_expr()
+            print(f"{workload}, size {depth}")
+            times = []
+            for name, make in tracers:
+                # `DebugTracer`'s output is discarded, it's the cost of making it that counts
+                with contextlib.redirect_stdout(io.StringIO()):
+                    seconds = min(
+                        timeit.repeat(
+                            lambda: make().interpret(expr), number=args.number, repeat=5
+                        )
+                    )
+                times.append(seconds / args.number)
+                print(f"{name: <24} {times[-1] * 1000:10.3f} ms")
+            print(
+                f"overhead: {times[1] / times[0]:.2f}x hooks, "
+                f"{times[2] / times[0]:.2f}x debug output, "
+                f"{times[3] / times[0]:.2f}x profiling\n"
+            )
+
+
+def arithmetic_program(depth: int) -> str:
+    # A balanced tree of operators `depth` levels deep, parenthesized since there's no precedence
+    def tree(depth: int, i: int) -> str:
+        if depth == 0:
+            return str(i % 9 + 1)
+        op = "+-*"[depth % 3]
+        return f"({tree(depth - 1, i * 2)} {op} {tree(depth - 1, i * 2 + 1)})"
+
+    return tree(depth, 0)
+
+
+# Each workload is scaled by its own parameter, picked so the sizes take comparable time
+SUITE: list[tuple[str, Callable[[int], str], list[int]]] = [
+    ("let chain", let_chain_program, [100, 1000]),
+    ("curried composition", curried_program, [6, 10]),
+    ("arithmetic tree", arithmetic_program, [8, 12]),
+    ("nesting", nested_program, [1000, 4000]),
+]
+
+
+def best_of(repeat: int, setup: Callable[[], Callable[[], object]]) -> float:
+    # Only the function `setup` returns is timed, with the garbage collector off like `timeit`
+    best = float("inf")
+    for _ in range(repeat):
+        f = setup()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            f()
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+def run_suite(repeat: int) -> list[dict]:
+    results = []
+    for workload, program, sizes in SUITE:
+        for size in sizes:
+            source = program(size)
+            expr = Parser(source).parse_expr()
+            phases = [
+                ("lex", lambda: lambda: tokenize(source)),
+                ("parse", lambda: Parser(source, compact=True).parse_expr),
+                ("eval", lambda: lambda: Interpret(None).interpret(expr)),
+            ]
+            for phase, setup in phases:
+                seconds = best_of(repeat, setup)
+                results.append(
+                    {
+                        "workload": workload,
+                        "size": size,
+                        "phase": phase,
+                        "bytes": len(source),
+                        "nodes": count_nodes(expr),
+                        "seconds": seconds,
+                    }
+                )
+    return results
+
+
+def result_key(result: dict) -> tuple[str, int, str]:
+    return result["workload"], result["size"], result["phase"]
+
+
+def bench_suite(args: argparse.Namespace):
+    results = run_suite(args.repeat)
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            saved = json.load(file)["results"]
+        baseline = {result_key(result): result for result in saved}
+
+    print(
+        f"{'workload': <20} {'size': >6} {'phase': <6} {'time': >12} {'MiB/s': >8} "
+        f"{'nodes/s': >12} {'vs baseline': >12}"
+    )
+    regressions = 0
+    for result in results:
+        seconds = result["seconds"]
+        line = (
+            f"{result['workload']: <20} {result['size']: >6} {result['phase']: <6} "
+            f"{seconds * 1000:9.3f} ms {result['bytes'] / seconds / 1024 / 1024:8.2f} "
+            f"{result['nodes'] / seconds: >12,.0f}"
+        )
+        if (old := baseline.get(result_key(result))) is not None:
+            ratio = seconds / old["seconds"]
+            line += f" {ratio: >11.2f}x"
+            if ratio > 1 + args.threshold:
+                regressions += 1
+                line += " REGRESSION"
+        print(line)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump({"python": platform.python_version(), "results": results}, file)
+            file.write("\n")
+    if regressions:
+        print(
+            f"\n{regressions} results more than {args.threshold:.0%} slower than baseline"
+        )
+        sys.exit(1)
+
+
+def bench_many(args: argparse.Namespace):
+    programs = [
+        lambda i: let_chain_program(20 + i % 50),
+        lambda i: curried_program(3 + i % 5),
+        lambda i: arithmetic_program(3 + i % 5),
+        lambda i: wide_program(200 + i % 400),
+    ]
+    options = main.Options()
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(args.files):
+            paths.append(os.path.join(directory, f"{i}.fun"))
+            with open(paths[-1], "w") as file:
+                file.write(programs[i % len(programs)](i))
+
+        print(f"{args.files} programs, {os.cpu_count()} CPUs")
+        # `main.py run` once per program, only for a few of them since it's so slow
+        some = paths[: args.processes]
+        start = time.perf_counter()
+        for path in some:
+            subprocess.run(
+                [sys.executable, main.__file__, "run", path], stdout=subprocess.DEVNULL
+            )
+        per_file = (time.perf_counter() - start) / len(some)
+        print(
+            f"{'run each': <12} {per_file * args.files * 1000:9.1f} ms "
+            f"{1 / per_file:9.0f} files/s"
+        )
+
+        start = time.perf_counter()
+        for path in paths:
+            main.run_file(path, options)
+        serial = time.perf_counter() - start
+        print(
+            f"{'serial': <12} {serial * 1000:9.1f} ms {args.files / serial:9.0f} files/s"
+        )
+
+        for jobs in args.jobs:
+            start = time.perf_counter()
+            # Starting the workers is part of the cost, so a new pool is timed every time
+            with ProcessPoolExecutor(jobs) as executor:
+                run = functools.partial(main.run_file, options=options)
+                for _ in executor.map(run, paths, chunksize=args.chunksize):
+                    pass
+            elapsed = time.perf_counter() - start
+            print(
+                f"{f'{jobs} workers': <12} {elapsed * 1000:9.1f} ms "
+                f"{args.files / elapsed:9.0f} files/s {serial / elapsed:6.2f}x"
+            )
+
+
+def bench_limits(args: argparse.Namespace):
+    generous = Limits(fuel=10**12, depth=10**6, int_bits=10**6)
+    interpreters: list[tuple[str, Callable[[], Interpret]]] = [
+        ("Interpret", lambda: Interpret(None)),
+        ("no limits", lambda: LimitedInterpret(None, Limits())),
+        ("all limits", lambda: LimitedInterpret(None, generous)),
+    ]
+    workloads = [
+        ("curried composition", curried_program),
+        ("arithmetic tree", arithmetic_program),
+        ("let chain", lambda n: let_chain_program(2**n)),
+    ]
+    for workload, program in workloads:
+        for size in args.sizes:
+            expr = Parser(program(size)).parse_expr()
+            print(f"{workload}, size {size}")
+            times = [
+                measure(name, lambda: make().interpret(expr), args.number)
+                for name, make in interpreters
+            ]
+            print(f"overhead: {times[2] / times[0]:.2f}x\n")
+
+
+def bench_incremental(args: argparse.Namespace):
+    print(
+        f"{'bytes': >10} {'full parse': >14} {'edit': >12} {'edit + expr': >14} "
+        f"{'full edits': >10}"
+    )
+    for size in args.sizes:
+        source = wide_program(size)
+        start = time.perf_counter()
+        document = incremental.Document(source)
+        full = time.perf_counter() - start
+
+        # Retype a digit in bindings spread across the whole program, lengthening it by one
+        # every time so the spans after it have to move
+        digits = [i for i, char in enumerate(source) if char.isdigit()]
+        offsets = [digits[i * len(digits) // args.edits] for i in range(args.edits)]
+        edit = expr = 0.0
+        full_edits = 0
+        for moved, offset in enumerate(offsets):
+            offset += moved
+            start = time.perf_counter()
+            document.edit(offset, 1, source[offset - moved] * 2)
+            edited = time.perf_counter()
+            document.expr
+            edit += edited - start
+            expr += time.perf_counter() - start
+            full_edits += document.full
+        print(
+            f"{len(source): >10} {full * 1000:11.3f} ms "
+            f"{edit / args.edits * 1000:9.3f} ms {expr / args.edits * 1000:11.3f} ms "
+            f"{full_edits: >10}"
+        )
+
+    # Edits should leave the same AST, or raise the same error, as parsing the edited source
+    # from scratch, including where the inserted text joins a token outside the segment
+    edits = [
+        ("let x = 1 in(x)", [(12, 0, "z")]),
+        ("let a = 1, b = (a)in b", [(18, 0, "x"), (15, 0, "i")]),
+    ]
+    rng = random.Random(0)
+    pieces = ["z", " ", "(", ")", "1", "in", "let ", ",", "=", "x", "+", " in ", ""]
+    for _ in range(500):
+        source = rng.choice([wide_program(50), curried_program(3), "let x = 1 in(x)"])
+        changes = []
+        for _ in range(5):
+            offset = rng.randrange(len(source) + 1)
+            removed = rng.randrange(min(3, len(source) - offset) + 1)
+            changes.append((offset, removed, rng.choice(pieces)))
+        edits.append((source, changes))
+
+    for source, changes in edits:
+        document = incremental.Document(source)
+        for offset, removed, inserted in changes:
+            source = source[:offset] + inserted + source[offset + removed :]
+            with contextlib.suppress(Exception):
+                # Raised again by `expr`
+                document.edit(offset, removed, inserted)
+            got = parse_outcome(lambda: document.expr)
+            expected = parse_outcome(lambda: Parser(source).parse_expr())
+            assert got == expected, f"{source!r}: expected {expected}, got {got}"
+    print(f"Edits parse the same as the edited source on {len(edits)} programs")
+
+
+def parse_outcome(parse: Callable[[], object]) -> str:
+    try:
+        return str(parse())
+    except Exception as exp:
+        return type(exp).__name__
+
+
+def bench_memo(args: argparse.Namespace):
+    workloads = [
+        ("curried composition", curried_program, args.depths),
+        ("church numerals", lambda n: numeral_program(n, tail=True), [50, 200]),
+    ]
+    for workload, program, sizes in workloads:
+        for size in sizes:
+            expr = Parser(program(size)).parse_expr()
+            print(f"{workload}, size {size}")
+            plain = measure("Interpret", lambda: Interpret(None).interpret(expr), 1)
+            pure = memo.pure_bodies(expr)
+            for capacity in args.capacities:
+                interpret = memo.MemoInterpret(None, pure, capacity)
+                interpret.interpret(expr)
+                memoised = measure(
+                    f"MemoInterpret({capacity})",
+                    lambda: memo.MemoInterpret(None, pure, capacity).interpret(expr),
+                    1,
+                )
+                print(f"{'': <24} {interpret.stats}, {plain / memoised:.2f}x")
+            print()
+
+
+def bench_typecheck(args: argparse.Namespace):
+    workloads = [
+        ("arithmetic tree", arithmetic_program, args.depths),
+        ("let chain", lambda n: let_chain_program(2**n), args.depths),
+        ("wide", lambda n: wide_program(2**n * 8), args.depths),
+        ("curried composition", curried_program, args.depths),
+    ]
+    for workload, program, sizes in workloads:
+        for size in sizes:
+            expr = Parser(program(size)).parse_expr()
+            print(f"{workload}, size {size}")
+            inference = measure("infer", lambda: typecheck.infer(expr), args.number)
+            checked = measure(
+                "Interpret", lambda: Interpret(None).interpret(expr), args.number
+            )
+            unchecked = measure(
+                "UncheckedInterpret",
+                lambda: typecheck.UncheckedInterpret(None).interpret(expr),
+                args.number,
+            )
+            print(
+                f"speedup: {checked / unchecked:.2f}x unchecked, "
+                f"{checked / (unchecked + inference):.2f}x including inference\n"
+            )
+
+
+def bench_batch(args: argparse.Namespace):
+    if batch.np is None:
+        print("batch needs NumPy, which isn't installed")
+        return
+    workloads = [
+        ("composition", PRELUDE + "cmp (add 1) (sub 1)", 1),
+        ("curried composition", curried_program(4).removesuffix(" 123"), 1),
+        ("polynomial", "fun x => ((x * x) + (3 * x)) - 7", 1),
+        ("overflowing", "fun x => (x * x) * (x * x)", 2**20),
+    ]
+    for workload, source, scale in workloads:
+        f = Interpret(None).interpret(Parser(source).parse_expr())
+        for size in args.sizes:
+            inputs = [(i - size // 2) * scale for i in range(size)]
+            # The scalar loop is only timed on a sample, or the big sizes take minutes
+            sample = inputs[:: max(1, size // args.sample)]
+            print(f"{workload}, {size} elements")
+            interpret = Interpret(None)
+            expected = [interpret.call(f, arg) for arg in sample]  # type: ignore
+            scalar = measure(
+                f"scalar loop ({len(sample)})",
+                lambda: [interpret.call(f, arg) for arg in sample],  # type: ignore
+                1,
+            )
+            vectorised = measure("batch.apply", lambda: batch.apply(f, inputs), 1)
+            assert batch.apply(f, sample) == expected
+            scalar_rate, vectorised_rate = len(sample) / scalar, size / vectorised
+            print(
+                f"{scalar_rate:,.0f} vs {vectorised_rate:,.0f} elements/s, "
+                f"{vectorised_rate / scalar_rate:.1f}x\n"
+            )
+
+
+def write_wide_program(path: str, size: int):
+    # Like `wide_program`, one binding per line, written as it goes so it's never all in memory
+    with open(path, "w") as file:
+        file.write("let x0 = 0")
+        i, length = 0, 0
+        while length < size:
+            i += 1
+            line = f",\n    x{i} = (fun a b => b - a) (x{i - 1} * 2) ({i} + x{i - 1} % 7)"
+            file.write(line)
+            length += len(line)
+        file.write(f"\nin x{i}\n")
+
+
+def lex_file(path: str, mapped: bool) -> tuple[float, float, int, int]:
+    # Runs in a fresh process for `bench_mmap`, so the growth in its peak RSS is only what
+    # lexing took. Returns the time to the first token and to the last, how many tokens there
+    # were and the growth in KiB
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    source = MappedSource(path) if mapped else open(path, "r").read()
+    tokens = FastLexer(source)
+    next(tokens)
+    first = time.perf_counter() - start
+    count = 1 + sum(1 for _ in tokens)
+    last = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    return first, last, count, peak
+
+
+def bench_mmap(args: argparse.Namespace):
+    spawn = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "wide.fun")
+        for size in args.sizes:
+            write_wide_program(path, size * 2**20)
+            print(f"{size} MiB")
+            for name, mapped in [("read", False), ("mmap", True)]:
+                with ProcessPoolExecutor(1, mp_context=spawn) as executor:
+                    first, last, count, peak = executor.submit(
+                        lex_file, path, mapped
+                    ).result()
+                print(
+                    f"{name: <6} first token {first * 1000:9.3f} ms, "
+                    f"all {count} in {last:7.2f} s, peak RSS +{peak / 1024:7.1f} MiB"
+                )
+            print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench", description="Benchmarks for python-fun"
+    )
+    benches = parser.add_subparsers(
+        required=True, help="The different benchmarks", dest="bench"
+    )
+
+    closure_parser = benches.add_parser(
+        "closure", help="Tree-walking interpreter vs closure compiler"
+    )
+    closure_parser.add_argument("--depths", type=int, nargs="+", default=[4, 8, 12])
+    closure_parser.add_argument("--number", type=int, default=10)
+    closure_parser.set_defaults(run=bench_closure)
+
+    vm_parser = benches.add_parser("vm", help="Bytecode VM vs the other engines")
+    vm_parser.add_argument("--depths", type=int, nargs="+", default=[4, 8, 12])
+    vm_parser.add_argument("--number", type=int, default=10)
+    vm_parser.set_defaults(run=bench_vm)
+
+    depth_parser = benches.add_parser(
+        "depth", help="Deep recursion on the Python stack vs the CEK machine"
+    )
+    depth_parser.add_argument(
+        "--depths", type=int, nargs="+", default=[100, 1000, 3000]
+    )
+    depth_parser.set_defaults(run=bench_depth)
+
+    inline_parser = benches.add_parser(
+        "inline", help="Applications and runtime with and without inlining"
+    )
+    inline_parser.add_argument("--depths", type=int, nargs="+", default=[4, 8, 12])
+    inline_parser.add_argument("--budget", type=int, default=inline.DEFAULT_BUDGET)
+    inline_parser.add_argument("--number", type=int, default=10)
+    inline_parser.set_defaults(run=bench_inline)
+
+    optimize_parser = benches.add_parser(
+        "optimize", help="Nodes removed and runtime with and without optimizing"
+    )
+    optimize_parser.add_argument("--sizes", type=int, nargs="+", default=[100, 400])
+    optimize_parser.add_argument("--number", type=int, default=10)
+    optimize_parser.set_defaults(run=bench_optimize)
+
+    env_parser = benches.add_parser(
+        "env", help="Immutable Env vs the old mutable dict-per-frame environments"
+    )
+    env_parser.add_argument("--sizes", type=int, nargs="+", default=[100, 400])
+    env_parser.add_argument("--bindings", type=int, default=10_000)
+    env_parser.add_argument("--number", type=int, default=3)
+    env_parser.set_defaults(run=bench_env)
+
+    lex_parser = benches.add_parser("lex", help="Lexer vs FastLexer throughput")
+    lex_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000]
+    )
+    lex_parser.set_defaults(run=bench_lex)
+
+    tokens_parser = benches.add_parser(
+        "tokens", help="Memory per token of Token objects vs TokenArrays"
+    )
+    tokens_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 1_000_000]
+    )
+    tokens_parser.add_argument("--number", type=int, default=1)
+    tokens_parser.set_defaults(run=bench_tokens)
+
+    ast_parser = benches.add_parser("ast", help="Memory per AST node")
+    ast_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100_000, 1_000_000]
+    )
+    ast_parser.set_defaults(run=bench_ast)
+
+    parse_parser = benches.add_parser(
+        "parse", help="Parser throughput on generated programs"
+    )
+    parse_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000, 1_000_000, 10_000_000],
+    )
+    parse_parser.set_defaults(run=bench_parse)
+
+    cache_parser = benches.add_parser(
+        "cache", help="Parsing vs loading from the parse cache"
+    )
+    cache_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    cache_parser.add_argument("--number", type=int, default=3)
+    cache_parser.set_defaults(run=bench_cache)
+
+    serialize_parser = benches.add_parser(
+        "serialize", help="Parsing vs loading a binary AST"
+    )
+    serialize_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    serialize_parser.add_argument("--number", type=int, default=3)
+    serialize_parser.set_defaults(run=bench_serialize)
+
+    lookup_parser = benches.add_parser(
+        "lookup", help="Variable lookup by name vs by lexical address"
+    )
+    lookup_parser.add_argument("--depths", type=int, nargs="+", default=[1, 10, 100])
+    lookup_parser.add_argument("--uses", type=int, default=200)
+    lookup_parser.add_argument("--number", type=int, default=10)
+    lookup_parser.set_defaults(run=bench_lookup)
+
+    trace_parser = benches.add_parser(
+        "trace", help="Evaluation with tracing off vs with tracing hooks and profiling"
+    )
+    trace_parser.add_argument("--depths", type=int, nargs="+", default=[4, 8])
+    trace_parser.add_argument("--number", type=int, default=5)
+    trace_parser.set_defaults(run=bench_trace)
+
+    limits_parser = benches.add_parser(
+        "limits", help="Evaluation with and without fuel, depth and integer size limits"
+    )
+    limits_parser.add_argument("--sizes", type=int, nargs="+", default=[6, 10])
+    limits_parser.add_argument("--number", type=int, default=5)
+    limits_parser.set_defaults(run=bench_limits)
+
+    incremental_parser = benches.add_parser(
+        "incremental", help="Edit-to-AST latency vs parsing everything again"
+    )
+    incremental_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    incremental_parser.add_argument("--edits", type=int, default=50)
+    incremental_parser.set_defaults(run=bench_incremental)
+
+    memo_parser = benches.add_parser(
+        "memo", help="Evaluation with and without memoising pure functions"
+    )
+    memo_parser.add_argument("--depths", type=int, nargs="+", default=[8, 12, 16])
+    memo_parser.add_argument("--capacities", type=int, nargs="+", default=[1, 256])
+    memo_parser.set_defaults(run=bench_memo)
+
+    typecheck_parser = benches.add_parser(
+        "typecheck", help="Checked evaluation vs unchecked after type inference"
+    )
+    typecheck_parser.add_argument("--depths", type=int, nargs="+", default=[8, 12])
+    typecheck_parser.add_argument("--number", type=int, default=5)
+    typecheck_parser.set_defaults(run=bench_typecheck)
+
+    batch_parser = benches.add_parser(
+        "batch", help="Applying a function to many integers, one by one vs with NumPy"
+    )
+    batch_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000]
+    )
+    batch_parser.add_argument(
+        "--sample", type=int, default=1_000, help="How many elements to loop over"
+    )
+    batch_parser.set_defaults(run=bench_batch)
+
+    mmap_parser = benches.add_parser(
+        "mmap", help="Lexing a large file read into a str vs mapped into memory"
+    )
+    mmap_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10, 100], help="In MiB"
+    )
+    mmap_parser.set_defaults(run=bench_mmap)
+
+    suite_parser = benches.add_parser(
+        "suite",
+        help="Lex, parse and eval times of generated workloads, against a baseline",
+    )
+    suite_parser.add_argument("--repeat", type=int, default=5)
+    suite_parser.add_argument(
+        "-o", "--output", metavar="PATH", help="Write the results to PATH as JSON"
+    )
+    suite_parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="Compare against results written by an earlier --output",
+    )
+    suite_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="How much slower than the baseline counts as a regression (default: 0.1)",
+    )
+    suite_parser.set_defaults(run=bench_suite)
+
+    many_parser = benches.add_parser(
+        "many", help="run-many throughput as the number of workers grows"
+    )
+    many_parser.add_argument("--files", type=int, default=2000)
+    many_parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8])
+    many_parser.add_argument("--chunksize", type=int, default=16)
+    many_parser.add_argument(
+        "--processes",
+        type=int,
+        default=20,
+        help="How many programs to time with a process each (default: 20)",
+    )
+    many_parser.set_defaults(run=bench_many)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Optional
+
+import serialize
+from expr import Expr, RawLetBind
+from parser import Parser
+
+DEFAULT_CAPACITY = 128
+
+# Part of every key, bump it whenever the parser's output changes so entries written by
+# older versions are never loaded
+FORMAT_VERSION = b"2"
+
+
+# REPL lines can also be definitions, see `Parser.parse_line`
+Parsed = Expr | list[RawLetBind]
+
+
+def source_key(source: str) -> str:
+    digest = hashlib.blake2b(FORMAT_VERSION, digest_size=16)
+    digest.update(source.encode())
+    return digest.hexdigest()
+
+
+def line_key(source: str) -> str:
+    # Definitions can't be written to disk, so REPL lines are only kept in memory under
+    # keys of their own
+    return f"line:{source_key(source)}"
+
+
+class ParseCache:
+    """
+    Maps a hash of the source to its parsed `Expr`, keeping the `capacity` most recently used
+    entries in memory and, given a `directory`, writing every entry there in the format from
+    `serialize.py` too
+
+    Note: Entries are keyed by content, so an edited file is always re-parsed no matter its
+    mtime. Parse errors are never cached
+    """
+
+    capacity: int
+    directory: Optional[str]
+    entries: OrderedDict[str, Parsed]
+    hits: int
+    misses: int
+
+    def __init__(
+        self, capacity: int = DEFAULT_CAPACITY, directory: Optional[str] = None
+    ) -> None:
+        self.capacity = capacity
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def parse(self, source: str) -> Expr:
+        key = source_key(source)
+        expr = self.get(key)
+        if expr is not None:
+            return expr
+
+        expr = self.load(key)
+        if expr is None:
+            self.misses += 1
+            expr = Parser(source).parse_expr()
+            self.store(key, expr)
+        else:
+            self.hits += 1
+
+        self.put(key, expr)
+        return expr
+
+    def get(self, key: str) -> Optional[Parsed]:
+        parsed = self.entries.get(key)
+        if parsed is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return parsed
+
+    def put(self, key: str, parsed: Parsed) -> None:
+        self.entries[key] = parsed
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def path(self, key: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, f"{key}.ast")
+
+    def load(self, key: str) -> Optional[Expr]:
+        if self.directory is None:
+            return None
+        try:
+            return serialize.load(self.path(key))
+        except FileNotFoundError:
+            return None
+        except serialize.BadFormat:
+            # A truncated or corrupt entry, it gets overwritten by `store`
+            return None
+
+    def store(self, key: str, expr: Expr) -> None:
+        if self.directory is None:
+            return
+        data = serialize.dumps(expr)
+        # Write to a temporary file first so readers never see a partial entry
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp, self.path(key))
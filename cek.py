@@ -0,0 +1,161 @@
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Op,
+    Print,
+)
+from interpret import Env, FunValue, NotBound, Ty, TypeMismatch, Value
+from utils import Spanned
+
+# Continuation frame tags, each frame is a tuple starting with one of these
+K_APP_ARG = 0  # (tag, app, env)            evaluate the argument next
+K_APP_CALL = 1  # (tag, app, f_value)       call the function with the value
+K_BINOP_RHS = 2  # (tag, bin_op, env)       evaluate the right operand next
+K_BINOP = 3  # (tag, bin_op, lhs_value)     combine both operands
+K_NEGATE = 4  # (tag, negate)
+K_PRINT = 5  # (tag,)
+K_LET_BIND = 6  # (tag, let_in, index, env) bind the value, then the next binding
+
+
+class Machine:
+    """
+    A CEK-style evaluator: the control is the current `Expr`, the environment is an `Env` like
+    `Interpret` uses, and the continuation is an explicit list of frames instead of the Python
+    call stack
+
+    Note: Applications (and `let` bodies) in tail position don't push a frame, so they run in
+    constant space. Results and errors are identical to `Interpret`
+    """
+
+    kont: list[tuple]
+
+    def __init__(self) -> None:
+        self.kont = []
+
+    def run(self, expr: Expr, env: Env) -> Value:
+        kont = self.kont
+        push = kont.append
+        pop = kont.pop
+
+        while True:
+            # Descend into the control until it produces a value
+            node = expr.data
+            match node:
+                case IntLit(num):
+                    value = num
+                case Ident(ident):
+                    match env[ident]:
+                        case Spanned(_, value):
+                            pass
+                        case None:
+                            raise NotBound(expr.span)
+                case Fun(param, body):
+                    value = FunValue(param=param, captures=env, body=body)
+                case App(f, _):
+                    push((K_APP_ARG, node, env))
+                    expr = f
+                    continue
+                case BinOp(_, lhs, _):
+                    push((K_BINOP_RHS, expr, env))
+                    expr = lhs
+                    continue
+                case Negate(operand):
+                    push((K_NEGATE, node))
+                    expr = operand
+                    continue
+                case Print(value_expr):
+                    push((K_PRINT,))
+                    expr = value_expr
+                    continue
+                case LetIn(bindings, body):
+                    if bindings:
+                        push((K_LET_BIND, node, 0, env))
+                        expr = bindings[0].value
+                    else:
+                        expr = body
+                    continue
+                case _:
+                    assert False, "unreachable"
+
+            # Feed the value to continuation frames until one has more work to do
+            while kont:
+                frame = pop()
+                tag = frame[0]
+                if tag == K_APP_ARG:
+                    _, app, env = frame
+                    push((K_APP_CALL, app, value))
+                    expr = app.arg
+                    break
+                elif tag == K_APP_CALL:
+                    _, app, f_value = frame
+                    if type(f_value) is not FunValue:
+                        raise TypeMismatch(
+                            span=app.f.span, expected=Ty.TY_FUN, got=Ty.TY_INT
+                        )
+                    # Tail call: nothing is pushed, the body inherits our continuation
+                    env = f_value.captures.extend(f_value.param, value)
+                    expr = f_value.body
+                    break
+                elif tag == K_BINOP_RHS:
+                    _, bin_op, env = frame
+                    push((K_BINOP, bin_op, value))
+                    expr = bin_op.data.rhs
+                    break
+                elif tag == K_BINOP:
+                    _, bin_op, lhs_value = frame
+                    value = self.bin_op(bin_op, lhs_value, value)
+                elif tag == K_NEGATE:
+                    if type(value) is FunValue:
+                        raise TypeMismatch(
+                            span=frame[1].expr.span, expected=Ty.TY_INT, got=Ty.TY_FUN
+                        )
+                    value = -value
+                elif tag == K_PRINT:
+                    print("<function value>" if type(value) is FunValue else value)
+                else:
+                    _, let_in, index, env = frame
+                    env = env.extend(let_in.bindings[index].name, value)
+                    index += 1
+                    if index < len(let_in.bindings):
+                        push((K_LET_BIND, let_in, index, env))
+                        expr = let_in.bindings[index].value
+                    else:
+                        expr = let_in.body
+                    break
+            else:
+                return value
+
+    def bin_op(self, bin_op: Expr, x: Value, y: Value) -> Value:
+        node = bin_op.data
+        assert isinstance(node, BinOp)
+
+        # Same error spans as `Interpret.bin_op`
+        if type(x) is FunValue:
+            span = bin_op.span if type(y) is FunValue else node.lhs.span
+            raise TypeMismatch(span=span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+        elif type(y) is FunValue:
+            raise TypeMismatch(span=node.rhs.span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+
+        match node.op.data:
+            case Op.OP_ADD:
+                return x + y
+            case Op.OP_SUB:
+                return x - y
+            case Op.OP_MUL:
+                return x * y
+            case Op.OP_DIV:
+                return x // y
+            case Op.OP_MOD:
+                return x % y
+
+        assert False, "unreachable"
+
+
+def evaluate(expr: Expr) -> Value:
+    return Machine().run(expr, Env())
@@ -0,0 +1,175 @@
+from typing import Any, Callable, Generator
+
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Op,
+    Print,
+    RawLetBind,
+)
+from interpret import Frame, FunValue, Ty, TypeMismatch, Value
+from resolve import resolve
+from utils import Span, Spanned, trampoline
+
+Closure = Callable[[Frame], Value]
+
+# Run by `trampoline`, so compiling deeply nested programs doesn't overflow the Python stack
+Steps = Generator["Steps", Any, Closure]
+
+
+class Compiler:
+    """
+    Compiles a resolved `Expr` (see `resolve.py`) into nested Python closures once, so evaluation
+    no longer has to re-dispatch on the node type every time it is reached
+
+    Note: Results and errors are identical to `Interpret`, including the spans attached to them.
+    Running the closures still recurses once per level of nesting, only compiling doesn't
+    """
+
+    def compile(self, expr: Expr) -> Closure:
+        return trampoline(self.compile_steps(expr))
+
+    def compile_steps(self, expr: Expr) -> Steps:
+        match expr.data:
+            case LetIn(bindings, body):
+                return (yield self.let_in(bindings, body))
+            case Fun(param, body):
+                return (yield self.fun(param, body))
+            case App(f, arg):
+                return (yield self.app(f, arg))
+            case Negate(operand):
+                # `Interpret` reports the operand's span here, so we do too
+                return (yield self.negate(operand.span, operand))
+            case BinOp(op, lhs, rhs):
+                return (yield self.bin_op(expr.span, op, lhs, rhs))
+            case Print(value):
+                return (yield self.printt(value))
+            case Ident(_) as ident:
+                return self.ident(ident)
+            case IntLit(num):
+                return lambda _: num
+            case _:
+                assert False, "unreachable"
+
+    def let_in(self, bindings: list[RawLetBind], body: Expr) -> Steps:
+        compiled = []
+        for bind in bindings:
+            code = yield self.compile_steps(bind.value)
+            compiled.append((bind.slot, code))
+        body_code = yield self.compile_steps(body)
+        empty = [None] * len(bindings)
+
+        def let_in(frame: Frame) -> Value:
+            frame = [frame, *empty]
+            for slot, value_code in compiled:
+                frame[slot] = value_code(frame)
+            return body_code(frame)
+
+        return let_in
+
+    def fun(self, param: Spanned[str], body: Expr) -> Steps:
+        code = yield self.compile_steps(body)
+        return lambda frame: FunValue(
+            param=param, captures=frame, body=body, code=code
+        )
+
+    def app(self, f: Expr, arg: Expr) -> Steps:
+        f_code = yield self.compile_steps(f)
+        arg_code = yield self.compile_steps(arg)
+        f_span = f.span
+
+        def app(frame: Frame) -> Value:
+            f_value = f_code(frame)
+            arg_value = arg_code(frame)
+
+            if type(f_value) is not FunValue:
+                raise TypeMismatch(span=f_span, expected=Ty.TY_FUN, got=Ty.TY_INT)
+
+            return f_value.code([f_value.captures, arg_value])
+
+        return app
+
+    def negate(self, span: Span, operand: Expr) -> Steps:
+        code = yield self.compile_steps(operand)
+
+        def negate(frame: Frame) -> Value:
+            value = code(frame)
+            if type(value) is FunValue:
+                raise TypeMismatch(span=span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+            return -value
+
+        return negate
+
+    def bin_op(self, span: Span, op: Spanned[Op], lhs: Expr, rhs: Expr) -> Steps:
+        lhs_code = yield self.compile_steps(lhs)
+        rhs_code = yield self.compile_steps(rhs)
+        lhs_span = lhs.span
+        rhs_span = rhs.span
+        apply = BINOP_IMPLS[op.data]
+
+        def bin_op(frame: Frame) -> Value:
+            x = lhs_code(frame)
+            y = rhs_code(frame)
+
+            if type(x) is FunValue:
+                got_span = span if type(y) is FunValue else lhs_span
+                raise TypeMismatch(span=got_span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+            elif type(y) is FunValue:
+                raise TypeMismatch(span=rhs_span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+
+            return apply(x, y)
+
+        return bin_op
+
+    def printt(self, value: Expr) -> Steps:
+        code = yield self.compile_steps(value)
+
+        def printt(frame: Frame) -> Value:
+            value = code(frame)
+            if type(value) is FunValue:
+                print("<function value>")
+            else:
+                print(value)
+            return value
+
+        return printt
+
+    def ident(self, ident: Ident) -> Closure:
+        depth, slot = ident.depth, ident.slot
+        assert depth is not None and slot is not None, "unresolved identifier"
+
+        # Unroll the common shallow cases so they're just indexing
+        match depth:
+            case 0:
+                return lambda frame: frame[slot]
+            case 1:
+                return lambda frame: frame[0][slot]
+            case 2:
+                return lambda frame: frame[0][0][slot]
+            case _:
+
+                def lookup(frame: Frame) -> Value:
+                    for _ in range(depth):
+                        frame = frame[0]
+                    return frame[slot]
+
+                return lookup
+
+
+BINOP_IMPLS: dict[Op, Callable[[int, int], int]] = {
+    Op.OP_ADD: lambda x, y: x + y,
+    Op.OP_SUB: lambda x, y: x - y,
+    Op.OP_MUL: lambda x, y: x * y,
+    Op.OP_DIV: lambda x, y: x // y,
+    Op.OP_MOD: lambda x, y: x % y,
+}
+
+
+def evaluate(expr: Expr) -> Value:
+    return Compiler().compile(resolve(expr))([None])
@@ -1,54 +1,77 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
+from typing import Optional
+from typing_extensions import Self
 from lexer import TK
 
-from utils import Spanned
+from utils import Span, Spanned
 
 
-@dataclass
-class RawLetBind:
-    name: Spanned[str]
-    value: "Expr"
+class Node:
+    """
+    Base for AST nodes, which keep their span inline as `start` and `end` rather than being
+    wrapped in a `Spanned` with a separate `Span`
 
-    def __str__(self) -> str:
-        return f"({self.name.data} {str(self.value.data)})"
+    Note: `span` and `data` let a node stand in wherever a `Spanned[RawExpr]` used to go
+    """
 
+    __slots__ = ()
 
-@dataclass
-class LetIn:
-    bindings: list[Spanned[RawLetBind]]
-    body: "Expr"
+    start: int
+    end: int
+
+    @property
+    def span(self) -> Span:
+        return Span(self.start, self.end)
+
+    @property
+    def data(self) -> "Self":
+        return self
 
     def __str__(self) -> str:
-        bindings = " ".join(map(str, self.bindings))
-        return f"(let [{bindings}] {str(self.body)})"
+        return render(self)
 
 
-@dataclass
-class Fun:
+@dataclass(slots=True)
+class RawLetBind(Node):
+    name: Spanned[str]
+    value: "Expr"
+    start: int
+    end: int
+    # Frame slot assigned by `resolve.Resolver`
+    slot: Optional[int] = field(default=None, repr=False, compare=False)
+
+
+@dataclass(slots=True)
+class LetIn(Node):
+    bindings: list[RawLetBind]
+    body: "Expr"
+    start: int
+    end: int
+
+
+@dataclass(slots=True)
+class Fun(Node):
     # Only a single parameter because of auto-currying
     param: Spanned[str]
     body: "Expr"
-
-    def __str__(self) -> str:
-        return f"(fun {self.param.data} {str(self.body)})"
+    start: int
+    end: int
 
 
-@dataclass
-class App:
+@dataclass(slots=True)
+class App(Node):
     f: "Expr"
     arg: "Expr"
-
-    def __str__(self) -> str:
-        return f"({str(self.f.data)} {str(self.arg.data)})"
+    start: int
+    end: int
 
 
-@dataclass
-class Negate:
+@dataclass(slots=True)
+class Negate(Node):
     expr: "Expr"
-
-    def __str__(self) -> str:
-        return f"(- {str(self.expr.data)})"
+    start: int
+    end: int
 
 
 class Op(Enum):
@@ -75,40 +98,104 @@ class Op(Enum):
                 assert False, "unreachable"
 
 
-@dataclass
-class BinOp:
+@dataclass(slots=True)
+class BinOp(Node):
     op: Spanned[Op]
     lhs: "Expr"
     rhs: "Expr"
-
-    def __str__(self) -> str:
-        return f"({self.op.data.value} {str(self.lhs.data)} {str(self.rhs.data)})"
+    start: int
+    end: int
 
 
-@dataclass
-class Print:
+@dataclass(slots=True)
+class Print(Node):
     value: "Expr"
-
-    def __str__(self) -> str:
-        return f"(print {str(self.value.data)})"
+    start: int
+    end: int
 
 
-@dataclass
-class Ident:
+@dataclass(slots=True)
+class Ident(Node):
     ident: str
-
-    def __str__(self) -> str:
-        return self.ident
+    start: int
+    end: int
+    # Lexical address assigned by `resolve.Resolver`
+    depth: Optional[int] = field(default=None, repr=False, compare=False)
+    slot: Optional[int] = field(default=None, repr=False, compare=False)
 
 
-@dataclass
-class IntLit:
+@dataclass(slots=True)
+class IntLit(Node):
     num: int
-
-    def __str__(self) -> str:
-        return str(self.num)
+    start: int
+    end: int
 
 
 RawExpr = LetIn | Fun | App | Negate | BinOp | Print | Ident | IntLit
 
-Expr = Spanned[RawExpr]
+# Nodes carry their own spans, so there's no wrapper any more
+Expr = RawExpr
+
+
+def children(expr: Expr) -> list[Expr]:
+    match expr:
+        case LetIn(bindings, body):
+            return [*(bind.value for bind in bindings), body]
+        case Fun(_, body) | Negate(body) | Print(body):
+            return [body]
+        case App(lhs, rhs) | BinOp(_, lhs, rhs):
+            return [lhs, rhs]
+        case Ident(_) | IntLit(_):
+            return []
+
+    assert False, "unreachable"
+
+
+def count_nodes(expr: Expr) -> int:
+    count = 0
+    pending = [expr]
+    while pending:
+        count += 1
+        pending.extend(children(pending.pop()))
+    return count
+
+
+def render(node: Node) -> str:
+    """
+    The S-expression `str` gives a node, built with a stack of pending nodes and text rather
+    than recursion, so it works however deeply the node is nested
+    """
+
+    parts: list[str] = []
+    # Popped from the end, so everything is pushed in reverse
+    pending: list[Node | str] = [node]
+    while pending:
+        match pending.pop():
+            case str(text):
+                parts.append(text)
+            case RawLetBind(name, value):
+                pending.extend([")", value, f"({name.data} "])
+            case LetIn(bindings, body):
+                pending.extend([")", body, "] "])
+                for index in reversed(range(len(bindings))):
+                    pending.append(bindings[index])
+                    if index > 0:
+                        pending.append(" ")
+                pending.append("(let [")
+            case Fun(param, body):
+                pending.extend([")", body, f"(fun {param.data} "])
+            case App(f, arg):
+                pending.extend([")", arg, " ", f, "("])
+            case Negate(operand):
+                pending.extend([")", operand, "(- "])
+            case BinOp(op, lhs, rhs):
+                pending.extend([")", rhs, " ", lhs, f"({op.data.value} "])
+            case Print(value):
+                pending.extend([")", value, "(print "])
+            case Ident(ident):
+                parts.append(ident)
+            case IntLit(num):
+                parts.append(str(num))
+            case _:
+                assert False, "unreachable"
+    return "".join(parts)
@@ -0,0 +1,225 @@
+from bisect import bisect_right
+from typing import Optional
+
+from expr import BinOp, Expr, Fun, LetIn, Node, RawLetBind, children
+from lexer import TK
+from parser import Parser
+
+
+class Shifts:
+    """
+    How far each segment of a `Document` has moved since its spans were last updated, as a
+    Fenwick tree so recording an edit and looking up a segment's shift are both O(log n)
+
+    Note: `add(i, delta)` moves segment `i` and every one after it
+    """
+
+    tree: list[int]
+
+    def __init__(self, size: int) -> None:
+        self.tree = [0] * (size + 1)
+
+    def add(self, index: int, delta: int) -> None:
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def __getitem__(self, index: int) -> int:
+        index += 1
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+class Document:
+    """
+    A source and its AST, kept up to date through `edit`s by re-lexing and re-parsing only the
+    top-level `let` binding (or the final body) the edit falls in
+
+    Note: Programs are split into segments along their spine, the chain of `let`s that each
+    make up the body of the last, so a program that isn't one big `let` has a single segment
+    and every edit re-parses all of it. Edits that span segments, that change where one ends,
+    or that touch a token outside their segment (which they might be lexed as part of) fall
+    back to parsing everything. The spans of the segments after an edit are only
+    shifted when `expr` is next read, since that touches every node in them
+    """
+
+    source: str
+    root: Expr
+    # The spine's `let`s, and the index of their first segments
+    lets: list[LetIn]
+    firsts: list[int]
+    # Every binding along the spine, then the final body
+    segments: list[RawLetBind | Expr]
+    shifts: Shifts
+    # Added to `shifts` for segments re-parsed since the last `expr`, whose spans are already
+    # up to date
+    corrections: dict[int, int]
+    moved: bool
+    # Whether the source stopped parsing, in which case the AST is out of date
+    broken: bool
+    # Whether the last `edit` had to parse everything, for `bench.py`
+    full: bool
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.parse()
+        self.full = True
+
+    def parse(self) -> None:
+        self.broken = True
+        self.root = Parser(self.source).parse_expr()
+        self.broken = False
+        self.lets = []
+        self.firsts = []
+        self.segments = []
+        expr = self.root
+        while isinstance(expr, LetIn) and expr.bindings:
+            self.lets.append(expr)
+            self.firsts.append(len(self.segments))
+            self.segments.extend(expr.bindings)
+            expr = expr.body
+        self.segments.append(expr)
+        # One more than there are segments, for edits to the body moving the end of the source
+        self.shifts = Shifts(len(self.segments) + 1)
+        self.corrections = {}
+        self.moved = False
+
+    def shift(self, index: int) -> int:
+        return self.shifts[index] + self.corrections.get(index, 0)
+
+    def find(self, start: int, end: int) -> Optional[int]:
+        # The segment that contains all of `start..end`, if there is one
+        low, high = 0, len(self.segments) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.segments[middle].start + self.shift(middle) <= start:
+                low = middle
+            else:
+                high = middle - 1
+
+        segment = self.segments[low]
+        shift = self.shift(low)
+        if segment.start + shift <= start and end <= segment.end + shift:
+            return low
+        return None
+
+    def edit(self, offset: int, removed: int, inserted: str) -> None:
+        """
+        Replaces the `removed` characters at `offset` with `inserted`
+
+        Note: Raises the same errors as `Parser.parse_expr` when the edit leaves the source
+        invalid, as does reading `expr` until another edit fixes it
+        """
+
+        source = self.source[:offset] + inserted + self.source[offset + removed :]
+        index = None if self.broken else self.find(offset, offset + removed)
+        if index is not None and self.touches(index, offset, offset + removed):
+            index = None
+        delta = len(inserted) - removed
+        self.full = index is None or not self.reparse(index, source, delta)
+        self.source = source
+        if self.full:
+            self.parse()
+
+    def touches(self, index: int, start: int, end: int) -> bool:
+        # Whether `start..end` is at an edge of the segment with no whitespace between it and
+        # the token on the other side, like inserting `z` before the `(x)` in `in(x)`
+        segment = self.segments[index]
+        shift = self.shift(index)
+        if start == segment.start + shift and start > 0:
+            if not self.source[start - 1].isspace():
+                return True
+        if end == segment.end + shift and end < len(self.source):
+            if not self.source[end].isspace():
+                return True
+        return False
+
+    def reparse(self, index: int, source: str, delta: int) -> bool:
+        old = self.segments[index]
+        shift = self.shift(index)
+        parser = Parser(source, start=old.start + shift)
+        is_body = index == len(self.segments) - 1
+        try:
+            if is_body:
+                new = parser.parse_expr()
+            else:
+                new = parser.trampoline(parser.parse_binding())
+        except Exception:
+            # Parsing everything raises it again, with the state left as it should be
+            return False
+
+        # Everything after the segment is unchanged, so as long as it still ends in the same
+        # place it's followed by the same tokens as before
+        if new.end != old.end + shift + delta:
+            return False
+        if is_body and parser.peek() != TK.TK_EOF:
+            return False
+
+        if not self.lets:
+            self.root = new
+        elif is_body:
+            self.lets[-1].body = new
+        else:
+            owner = bisect_right(self.firsts, index) - 1
+            self.lets[owner].bindings[index - self.firsts[owner]] = new  # type: ignore
+        self.segments[index] = new
+
+        # The new segment's spans are already right, whatever happened before it
+        self.corrections[index] = -self.shifts[index]
+        self.shifts.add(index + 1, delta)
+        self.moved = True
+        return True
+
+    @property
+    def expr(self) -> Expr:
+        """
+        The AST of the current source, shifting the spans of segments moved by edits first
+        """
+
+        if self.broken:
+            # Raises the error that stopped it parsing
+            self.parse()
+        if not self.moved:
+            return self.root
+
+        for index, segment in enumerate(self.segments):
+            if (shift := self.shift(index)) != 0:
+                shift_spans(segment, shift)
+        total = self.shifts[len(self.segments)]
+        for let, first in zip(self.lets, self.firsts):
+            let.start += self.shifts[first]
+            let.end += total
+        self.shifts = Shifts(len(self.segments) + 1)
+        self.corrections = {}
+        self.moved = False
+        return self.root
+
+
+def shift_spans(node: Node, delta: int) -> None:
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        node.start += delta
+        node.end += delta
+        match node:
+            case RawLetBind(name, value):
+                name.span.start += delta
+                name.span.end += delta
+                pending.append(value)
+            case LetIn(bindings, body):
+                pending.extend(bindings)
+                pending.append(body)
+            case Fun(param, body):
+                param.span.start += delta
+                param.span.end += delta
+                pending.append(body)
+            case BinOp(op, lhs, rhs):
+                op.span.start += delta
+                op.span.end += delta
+                pending.extend([lhs, rhs])
+            case _:
+                pending.extend(children(node))  # type: ignore
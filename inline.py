@@ -0,0 +1,266 @@
+from itertools import count
+from typing import Any, Generator
+
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Print,
+    RawLetBind,
+    count_nodes,
+)
+from optimize import respan
+from utils import Spanned, trampoline
+
+DEFAULT_BUDGET = 16
+
+# How many applications may be inlined in total, and inside one another, since functions
+# applied to themselves (like `fun x => x x`) can be inlined forever
+MAX_STEPS = 1000
+MAX_NESTING = 32
+
+# Run by `trampoline`, so deeply nested programs don't overflow the Python stack
+Steps = Generator["Steps", Any, Expr]
+FreeSteps = Generator["FreeSteps", Any, set[str]]
+
+
+def free_vars(expr: Expr) -> set[str]:
+    return trampoline(free_vars_steps(expr))
+
+
+def free_vars_steps(expr: Expr) -> FreeSteps:
+    match expr:
+        case LetIn(bindings, body):
+            free = yield free_vars_steps(body)
+            for bind in reversed(bindings):
+                free.discard(bind.name.data)
+                free |= yield free_vars_steps(bind.value)
+            return free
+        case Fun(param, body):
+            return (yield free_vars_steps(body)) - {param.data}
+        case App(lhs, rhs) | BinOp(_, lhs, rhs):
+            return (yield free_vars_steps(lhs)) | (yield free_vars_steps(rhs))
+        case Negate(operand) | Print(operand):
+            return (yield free_vars_steps(operand))
+        case Ident(ident):
+            return {ident}
+        case IntLit(_):
+            return set()
+
+    assert False, "unreachable"
+
+
+def is_fresh(name: str) -> bool:
+    # The lexer never produces a `'`, so only `Inliner.fresh` makes names like these
+    return "'" in name
+
+
+Known = dict[str, tuple[Fun, set[str]]]
+
+
+class Inliner:
+    """
+    Substitutes small `let`-bound functions at the sites where they're applied, beta-reducing
+    `(fun x => body) arg` to `let x' = arg in body` with a fresh `x'`
+
+    Note: A `let` binding can only see the bindings before it, so `let`-bound functions aren't
+    recursive, but one can still be applied to itself, so inlining stops after `MAX_STEPS`
+    applications, or `MAX_NESTING` inside one another. Inlining is capture-avoiding: a function
+    is only inlined where none of its free variables have been shadowed, and every name the
+    inliner binds is fresh, so `let`s it creates can be merged into the surrounding ones
+    """
+
+    budget: int
+    fresh_names: count
+    # How many more applications may be inlined, and how many are being inlined right now
+    steps: int
+    nesting: int
+
+    def __init__(self, budget: int = DEFAULT_BUDGET) -> None:
+        self.budget = budget
+        self.fresh_names = count(1)
+        self.steps = MAX_STEPS
+        self.nesting = 0
+
+    def fresh(self, name: str) -> str:
+        base, _, _ = name.partition("'")
+        return f"{base}'{next(self.fresh_names)}"
+
+    def instantiate_steps(self, expr: Expr, names: dict[str, str]) -> Steps:
+        """
+        Copies `expr`, replacing free occurrences of the keys of `names` with their values, and
+        giving every binding the inliner made a fresh name so it stays unique
+
+        Note: This always makes a fresh copy, since later passes annotate `Ident`s in place
+        """
+
+        match expr:
+            case LetIn(bindings, body):
+                renamed = []
+                names = dict(names)
+                for bind in bindings:
+                    value = yield self.instantiate_steps(bind.value, names)
+                    name = bind.name
+                    if is_fresh(name.data):
+                        name = Spanned(span=name.span, data=self.fresh(name.data))
+                        names[bind.name.data] = name.data
+                    else:
+                        names.pop(name.data, None)
+                    renamed.append(RawLetBind(name, value, bind.start, bind.end))
+                body = yield self.instantiate_steps(body, names)
+                return LetIn(renamed, body, expr.start, expr.end)
+            case Fun(param, body):
+                names = {old: new for old, new in names.items() if old != param.data}
+                body = yield self.instantiate_steps(body, names)
+                return Fun(param, body, expr.start, expr.end)
+            case App(f, arg):
+                f = yield self.instantiate_steps(f, names)
+                arg = yield self.instantiate_steps(arg, names)
+                return App(f, arg, expr.start, expr.end)
+            case BinOp(op, lhs, rhs):
+                lhs = yield self.instantiate_steps(lhs, names)
+                rhs = yield self.instantiate_steps(rhs, names)
+                return BinOp(op, lhs, rhs, expr.start, expr.end)
+            case Negate(operand):
+                operand = yield self.instantiate_steps(operand, names)
+                return Negate(operand, expr.start, expr.end)
+            case Print(value):
+                value = yield self.instantiate_steps(value, names)
+                return Print(value, expr.start, expr.end)
+            case Ident(ident):
+                return Ident(names.get(ident, ident), expr.start, expr.end)
+            case IntLit(num):
+                return IntLit(num, expr.start, expr.end)
+
+        assert False, "unreachable"
+
+    def inline(self, expr: Expr, known: Known) -> Expr:
+        return trampoline(self.inline_steps(expr, known))
+
+    def inline_steps(self, expr: Expr, known: Known) -> Steps:
+        match expr:
+            case LetIn(bindings, body):
+                return (yield self.let_in(expr, bindings, body, known))
+            case Fun(param, body):
+                body = yield self.inline_steps(body, shadow(known, param.data))
+                return Fun(param, body, expr.start, expr.end)
+            case App(f, arg):
+                f = yield self.inline_steps(f, known)
+                arg = yield self.inline_steps(arg, known)
+                return (yield self.app(expr, f, arg, known))
+            case BinOp(op, lhs, rhs):
+                lhs = yield self.inline_steps(lhs, known)
+                rhs = yield self.inline_steps(rhs, known)
+                return BinOp(op, lhs, rhs, expr.start, expr.end)
+            case Negate(operand):
+                operand = yield self.inline_steps(operand, known)
+                return Negate(operand, expr.start, expr.end)
+            case Print(value):
+                value = yield self.inline_steps(value, known)
+                return Print(value, expr.start, expr.end)
+            case Ident(_) | IntLit(_):
+                return expr
+
+        assert False, "unreachable"
+
+    def let_in(
+        self, expr: Expr, bindings: list[RawLetBind], body: Expr, known: Known
+    ) -> Steps:
+        inlined: list[RawLetBind] = []
+        for bind in bindings:
+            value = yield self.inline_steps(bind.value, known)
+            known = self.bind(inlined, bind, value, known)
+
+        return let(inlined, (yield self.inline_steps(body, known)), expr)
+
+    def bind(
+        self, bindings: list[RawLetBind], bind: RawLetBind, value: Expr, known: Known
+    ) -> Known:
+        # Hoist `let`s the inliner made out of the value, exposing functions inside them
+        while isinstance(value, LetIn) and all_fresh(value.bindings):
+            bindings.extend(value.bindings)
+            value = value.body
+
+        name = bind.name.data
+        bindings.append(RawLetBind(bind.name, value, bind.start, bind.end))
+        shadowed = shadow(known, name)
+        match value:
+            case Fun(_, _) if count_nodes(value) <= self.budget:
+                free = free_vars(value)
+                # Where `name` is used it means this function, not the outer `name` it uses
+                if name not in free:
+                    shadowed[name] = (value, free)
+            case Ident(alias) if alias in known:
+                # Binding a known function to another name, like `cmp` does with its arguments
+                shadowed[name] = known[alias]
+        return shadowed
+
+    def app(self, expr: Expr, f: Expr, arg: Expr, known: Known) -> Steps:
+        if self.steps == 0 or self.nesting == MAX_NESTING:
+            return App(f, arg, expr.start, expr.end)
+        match f:
+            case Ident(name) if name in known:
+                fun, _ = known[name]
+                return (yield self.beta(expr, fun, arg, known))
+            case Fun(_, _):
+                return (yield self.beta(expr, f, arg, known))
+            case LetIn(bindings, body) if all_fresh(bindings):
+                # The bindings are fresh, so moving `arg` inside them can't capture anything,
+                # as long as `body` can take the span of the function it's replacing
+                moved = respan(body, f)
+                if moved is not None:
+                    known = shadow_all(known, bindings)
+                    applied = yield self.app(expr, moved, arg, known)
+                    return let(list(bindings), applied, expr)
+        return App(f, arg, expr.start, expr.end)
+
+    def beta(self, expr: Expr, fun: Fun, arg: Expr, known: Known) -> Steps:
+        param = fun.param
+        fresh = Spanned(span=param.span, data=self.fresh(param.data))
+        bindings: list[RawLetBind] = []
+        known = self.bind(
+            bindings, RawLetBind(fresh, arg, arg.start, arg.end), arg, known
+        )
+        # The copied body may apply functions that are only known now
+        self.steps -= 1
+        self.nesting += 1
+        copied = yield self.instantiate_steps(fun.body, {param.data: fresh.data})
+        body = yield self.inline_steps(copied, known)
+        self.nesting -= 1
+        return let(bindings, body, expr)
+
+
+def let(bindings: list[RawLetBind], body: Expr, span: Expr) -> Expr:
+    # `let a in let b in body` is the same as `let a, b in body`
+    if isinstance(body, LetIn):
+        bindings.extend(body.bindings)
+        body = body.body
+    return LetIn(bindings, body, span.start, span.end)
+
+
+def all_fresh(bindings: list[RawLetBind]) -> bool:
+    return all(is_fresh(bind.name.data) for bind in bindings)
+
+
+def shadow(known: Known, name: str) -> Known:
+    # Functions that refer to an outer `name` can't be inlined where it's been rebound
+    return {
+        fun_name: (fun, free)
+        for fun_name, (fun, free) in known.items()
+        if fun_name != name and name not in free
+    }
+
+
+def shadow_all(known: Known, bindings: list[RawLetBind]) -> Known:
+    for bind in bindings:
+        known = shadow(known, bind.name.data)
+    return known
+
+
+def inline(expr: Expr, budget: int = DEFAULT_BUDGET) -> Expr:
+    return Inliner(budget).inline(expr, {})
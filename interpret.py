@@ -1,7 +1,8 @@
-from dataclasses import dataclass
+import sys
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Optional
-from pprint import pprint
+from typing import Any, Optional
 from expr import (
     App,
     Expr,
@@ -40,36 +41,87 @@ class TypeMismatch(RuntimeError):
 
 
 @dataclass
+class OutOfFuel(RuntimeError):
+    span: Span
+
+
+@dataclass
+class TooDeep(RuntimeError):
+    span: Span
+    depth: int
+
+
+@dataclass
+class IntTooLarge(RuntimeError):
+    span: Span
+    bits: int
+
+
+@dataclass
+class Limits:
+    # How many function calls may be made. Without calls a program does work proportional to
+    # its size, so this bounds the total work without a check on every node
+    fuel: Optional[int] = None
+    # How many function calls may be in progress at once
+    depth: Optional[int] = None
+    # How many bits the result of an arithmetic operation may have
+    int_bits: Optional[int] = None
+
+
+@dataclass(frozen=True, slots=True)
 class Env:
-    # This feels like a bad decision
-    enclosing: "Optional[Env]"
-    bindings: dict[str, "Spanned[Value]"]
+    """
+    An immutable environment: a single binding plus the environment it extends, so extending
+    is O(1) and a closure captures a snapshot just by keeping a reference to one
 
-    def __init__(self, enclosing: "Optional[Env]"):
-        self.enclosing = enclosing
-        self.bindings = {}
+    Note: The empty environment is `Env()`, with no binding
+    """
+
+    enclosing: "Optional[Env]" = None
+    name: Optional[str] = None
+    binding: "Optional[Spanned[Value]]" = None
 
     def __getitem__(self, ident: str) -> "Optional[Spanned[Value]]":
-        match (self.bindings.get(ident, None), self.enclosing):
-            case (Spanned(_, _) as value, _):
-                return value
-            case (None, Env(_, _) as enclosing):
-                return enclosing[ident]
-            case _:
-                return None
+        # A loop rather than recursion, so long scope chains can't overflow the stack
+        env: Optional[Env] = self
+        while env is not None:
+            if env.name == ident:
+                return env.binding
+            env = env.enclosing
+        return None
+
+    def extend(self, ident: Spanned[str], value: "Value") -> "Env":
+        return Env(self, ident.data, Spanned(ident.span, value))
 
-    def __setitem__(self, ident: Spanned[str], value: "Value") -> None:
-        self.bindings[ident.data] = ident.map_data(lambda _: value)
+    def names(self, frame: "Optional[Env]" = None) -> list[str]:
+        # The names bound since `frame`, in the order they were first bound, like the keys of
+        # the dict each frame used to be
+        names = []
+        env: Optional[Env] = self
+        while env is not None and env is not frame:
+            if env.name is not None:
+                names.append(env.name)
+            env = env.enclosing
+        return list(dict.fromkeys(reversed(names)))
 
-    def __delitem__(self, ident: Spanned[str]) -> None:
-        del self.bindings[ident.data]
+
+# An array-backed environment for resolved programs (see `resolve.py`):
+# the enclosing frame lives at index 0, followed by the frame's slots
+Frame = list[Any]
+
+# A function's results by argument, see `memo.py`
+Memo = OrderedDict[int, "Value"]
 
 
 @dataclass
 class FunValue:
     param: Spanned[str]
-    captures: Env
+    captures: Env | Frame
     body: Expr
+    # Filled in by the compiling engines, see `closure.py` and `vm.py`
+    code: Optional[Any] = field(default=None, repr=False, compare=False)
+    # Results by argument, for pure functions under `memo.MemoInterpret`
+    memo: Optional[Memo] = field(default=None, repr=False, compare=False)
 
 
 Value = int | FunValue
@@ -79,7 +131,7 @@ class Interpret:
     env: Env
 
     def __init__(self, env: Optional[Env]) -> None:
-        self.env = Env(env)
+        self.env = Env() if env is None else env
 
     def interpret(self, expr: Expr) -> Value:
         match expr.data:
@@ -102,39 +154,38 @@ class Interpret:
             case _:
                 assert False, "unreachable"
 
-    def let_in(self, bindings: list[Spanned[RawLetBind]], body: Expr) -> Value:
+    def let_in(self, bindings: list[RawLetBind], body: Expr) -> Value:
+        previous = self.env
         for bind in bindings:
-            value = self.interpret(bind.data.value)
-            self.env[bind.data.name] = value
+            value = self.interpret(bind.value)
+            # Each binding extends the environment, closures keep the one they were made in
+            self.env = self.env.extend(bind.name, value)
         body_value = self.interpret(body)
-
-        for bind in bindings:
-            del self.env[bind.data.name]
+        self.env = previous
 
         return body_value
 
     def fun(self, span: Span, param: Spanned[str], body: Expr) -> Value:
-        # A little bit of debubbing
-        print(f"\n{str(Fun(param, body))}")
-        pprint([binding[0] for binding in self.env.bindings.items()])
-        return FunValue(param=param, captures=Env(self.env), body=body)
+        # See `tracing.DebugTracer` for the debugging output this used to print
+        return FunValue(param=param, captures=self.env, body=body)
 
     def app(self, f: Expr, arg: Expr) -> Value:
         f_value = self.interpret(f)
         arg_value = self.interpret(arg)
 
         match f_value:
-            case FunValue(param, env, body):
-                previous = self.env
-                self.env = env
-                self.env[param] = arg_value
-                result = self.interpret(body)
-                del self.env[param]
-                self.env = previous
-                return result
+            case FunValue():
+                return self.call(f_value, arg_value)
             case int(_):
                 raise TypeMismatch(span=f.span, expected=Ty.TY_FUN, got=Ty.TY_INT)
 
+    def call(self, f: FunValue, arg: Value) -> Value:
+        previous = self.env
+        self.env = f.captures.extend(f.param, arg)
+        result = self.interpret(f.body)
+        self.env = previous
+        return result
+
     def negate(self, span: Span, expr: Expr) -> Value:
         value = self.interpret(expr)
         match value:
@@ -146,35 +197,14 @@ class Interpret:
     def bin_op(self, span: Span, op: Spanned[Op], lhs: Expr, rhs: Expr) -> Value:
         lhs_value = self.interpret(lhs)
         rhs_value = self.interpret(rhs)
-
-        match (lhs_value, rhs_value):
-            case (int(x), int(y)):
-                match op:
-                    case Op.OP_ADD:
-                        return x + y
-                    case Op.OP_SUB:
-                        return x - y
-                    case Op.OP_MUL:
-                        return x * y
-                    case Op.OP_DIV:
-                        return x // y
-                    case Op.OP_MOD:
-                        return x % y
-            case (int(x), FunValue(_, _)):
-                raise TypeMismatch(span=rhs.span, expected=Ty.TY_INT, got=Ty.TY_FUN)
-            case (FunValue(_, _), int(y)):
-                raise TypeMismatch(span=lhs.span, expected=Ty.TY_INT, got=Ty.TY_FUN)
-            case _:
-                raise TypeMismatch(span=span, expected=Ty.TY_INT, got=Ty.TY_FUN)
-
-        assert False, "unreachable"
+        return arithmetic(span, op, lhs, lhs_value, rhs, rhs_value)
 
     def printt(self, expr: Expr) -> Value:
         value = self.interpret(expr)
         match value:
             case int(num):
                 print(num)
-            case Fun(_, _):
+            case FunValue(_, _, _):
                 print("<function value>")
 
         return value
@@ -187,3 +217,78 @@ class Interpret:
                 raise NotBound(span)
 
         assert False, "unreachable"
+
+
+def arithmetic(
+    span: Span, op: Spanned[Op], lhs: Expr, lhs_value: Value, rhs: Expr, rhs_value: Value
+) -> Value:
+    match (lhs_value, rhs_value):
+        case (int(x), int(y)):
+            match op.data:
+                case Op.OP_ADD:
+                    return x + y
+                case Op.OP_SUB:
+                    return x - y
+                case Op.OP_MUL:
+                    return x * y
+                case Op.OP_DIV:
+                    return x // y
+                case Op.OP_MOD:
+                    return x % y
+        case (int(x), FunValue(_, _)):
+            raise TypeMismatch(span=rhs.span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+        case (FunValue(_, _), int(y)):
+            raise TypeMismatch(span=lhs.span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+        case _:
+            raise TypeMismatch(span=span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+
+    assert False, "unreachable"
+
+
+class LimitedInterpret(Interpret):
+    """
+    An `Interpret` that gives up on programs that run for too long, call too deeply or make
+    integers that are too large, as set by `limits`
+
+    Note: Like `tracing.TracingInterpret`, the checks live in a subclass so `Interpret` doesn't
+    pay for them. Each one is an integer comparison, since missing limits become `sys.maxsize`
+    """
+
+    fuel: int
+    max_depth: int
+    depth: int
+    int_bits: int
+
+    def __init__(self, env: Optional[Env], limits: Limits) -> None:
+        super().__init__(env)
+        self.fuel = sys.maxsize if limits.fuel is None else limits.fuel
+        self.max_depth = sys.maxsize if limits.depth is None else limits.depth
+        self.depth = 0
+        self.int_bits = sys.maxsize if limits.int_bits is None else limits.int_bits
+
+    def call(self, f: FunValue, arg: Value) -> Value:
+        self.fuel -= 1
+        if self.fuel < 0:
+            raise OutOfFuel(f.body.span)
+        self.depth += 1
+        if self.depth > self.max_depth:
+            raise TooDeep(f.body.span, self.depth)
+        result = super().call(f, arg)
+        self.depth -= 1
+        return result
+
+    def bin_op(self, span: Span, op: Spanned[Op], lhs: Expr, rhs: Expr) -> Value:
+        lhs_value = self.interpret(lhs)
+        rhs_value = self.interpret(rhs)
+        # Integer literals are never checked, so the operands are checked before the operation,
+        # which keeps the result at most twice as large as the limit
+        for operand, operand_value in [(lhs, lhs_value), (rhs, rhs_value)]:
+            if (
+                isinstance(operand_value, int)
+                and operand_value.bit_length() > self.int_bits
+            ):
+                raise IntTooLarge(operand.span, operand_value.bit_length())
+        value = arithmetic(span, op, lhs, lhs_value, rhs, rhs_value)
+        if isinstance(value, int) and value.bit_length() > self.int_bits:
+            raise IntTooLarge(span, value.bit_length())
+        return value
@@ -1,6 +1,11 @@
+import mmap
+import os
+import re
+import sys
+from array import array
 from dataclasses import dataclass
 from enum import Enum
-from typing import Callable, Optional, TypeVar
+from typing import Any, Callable, Iterator, Optional, TypeVar
 from typing_extensions import override
 
 from utils import Span, Spanned, map_pred
@@ -27,7 +32,7 @@ class TK(Enum):
     TK_EOF = "EOF"
 
 
-@dataclass
+@dataclass(slots=True)
 class Token(Spanned[TK]):
     span: Span
     data: TK
@@ -35,7 +40,7 @@ class Token(Spanned[TK]):
     def __str__(self) -> str:
         return f"{self.data.value: <15} @ {str(self.span)}"
 
-    def get_source(self, source: str) -> Spanned[str]:
+    def get_source(self, source: "str | MappedSource") -> Spanned[str]:
         return Spanned(span=self.span, data=source[self.span.start : self.span.end])
 
     T = TypeVar("T")
@@ -188,3 +193,225 @@ class Lexer:
                 return Token(span, data)
 
         assert False, "unreachable"
+
+
+KEYWORDS = {
+    "let": TK.TK_LET,
+    "in": TK.TK_IN,
+    "fun": TK.TK_FUN,
+    "print": TK.TK_PRINT,
+}
+
+SYMBOLS = {
+    "=>": TK.TK_ARROW,
+    "=": TK.TK_ASSIGN,
+    "(": TK.TK_LPAREN,
+    ")": TK.TK_RPAREN,
+    ",": TK.TK_COMMA,
+    "+": TK.TK_ADD,
+    "-": TK.TK_SUB,
+    "*": TK.TK_MUL,
+    "/": TK.TK_DIV,
+    "%": TK.TK_MOD,
+}
+
+# Skips whitespace and comments, then captures one token in the group for its kind:
+# 1 = identifier or keyword, 2 = integer, 3 = symbol, 4 = anything else (invalid)
+TOKEN_RE = re.compile(
+    r"(?:[ \t\r\n]+|#[^\n]*)*(?:([^\W\d]\w*)|(\d+)|(=>|[=(),+\-*/%])|(.))?", re.DOTALL
+)
+
+# The same as `TOKEN_RE`, for `MappedSource`s, except that every byte outside ASCII counts as
+# part of an identifier, so UTF-8 encoded letters in them still work
+BYTES_TOKEN_RE = re.compile(
+    rb"(?:[ \t\r\n]+|#[^\n]*)*"
+    rb"(?:([A-Za-z_\x80-\xff][\w\x80-\xff]*)|(\d+)|(=>|[=(),+\-*/%])|(.))?",
+    re.DOTALL,
+)
+
+BYTES_KEYWORDS = {word.encode(): kind for word, kind in KEYWORDS.items()}
+BYTES_SYMBOLS = {symbol.encode(): kind for symbol, kind in SYMBOLS.items()}
+
+# How many bytes of a `MappedSource` the lexers scan between calls to `release`
+RELEASE_INTERVAL = 16 * 2**20
+
+
+class MappedSource:
+    """
+    A source file mapped into memory rather than read and decoded into a `str`, which the
+    lexers scan as bytes and `Parser` only decodes the identifiers and integers of
+
+    Note: Spans are in bytes rather than characters, which only differs for source that isn't
+    ASCII. Anything outside ASCII lexes as part of an identifier, even where `Lexer` would say
+    it's invalid. The lexers `release` what they've scanned as they go, or else every page of
+    the file they touch would stay in memory until the end
+    """
+
+    buffer: mmap.mmap | bytes
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            # Empty files can't be mapped
+            if os.fstat(file.fileno()).st_size == 0:
+                self.buffer = b""
+            else:
+                self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self) -> "MappedSource":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+    def __getitem__(self, index: slice) -> str:
+        return self.buffer[index].decode()
+
+    def release(self, offset: int) -> None:
+        # Lets the kernel take back the pages before `offset`, which are read from the file
+        # again (or the page cache) if they're ever needed
+        end = offset - offset % mmap.PAGESIZE
+        if end > 0 and isinstance(self.buffer, mmap.mmap) and RELEASE_PAGES:
+            self.buffer.madvise(mmap.MADV_DONTNEED, 0, end)
+
+    def close(self) -> None:
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+# `madvise` is only on some platforms
+RELEASE_PAGES = hasattr(mmap, "MADV_DONTNEED")
+
+
+def releaser(source: "str | MappedSource") -> tuple[Callable[[int], None], int]:
+    # What to call as scanning passes offsets, and the first offset to call it at
+    if isinstance(source, MappedSource) and RELEASE_PAGES:
+        return source.release, RELEASE_INTERVAL
+    return lambda _: None, sys.maxsize
+
+
+def scanner(
+    source: "str | MappedSource",
+) -> tuple[Any, Callable[[Any, int], re.Match], dict[Any, TK], dict[Any, TK]]:
+    # What to match tokens in, what with, and where to look up the keywords and symbols found
+    if isinstance(source, MappedSource):
+        return source.buffer, BYTES_TOKEN_RE.match, BYTES_KEYWORDS, BYTES_SYMBOLS
+    return source, TOKEN_RE.match, KEYWORDS, SYMBOLS
+
+
+class FastLexer:
+    """
+    A drop-in replacement for `Lexer` that produces the same tokens, but scans each one (along
+    with the whitespace and comments before it) with a single match of `TOKEN_RE`
+
+    Note: Identifiers are a letter or underscore followed by letters, digits or underscores
+    """
+
+    source: "str | MappedSource"
+    # Where to start scanning, which must be between two tokens
+    start: int
+    tokens: Iterator[Token]
+
+    def __init__(self, source: "str | MappedSource", start: int = 0):
+        self.source = source
+        self.start = start
+        self.tokens = self.scan()
+
+    def __iter__(self) -> "FastLexer":
+        return self
+
+    def __next__(self) -> Token:
+        return next(self.tokens)
+
+    def scan(self) -> Iterator[Token]:
+        source, scan_token, keywords, symbols = scanner(self.source)
+        release, release_at = releaser(self.source)
+        pos = self.start
+
+        while (m := scan_token(source, pos)).lastindex is not None:
+            group = m.lastindex
+            start, pos = m.span(group)
+            if pos >= release_at:
+                release(start)
+                release_at = pos + RELEASE_INTERVAL
+            match group:
+                case 1:
+                    kind = keywords.get(m.group(1), TK.TK_IDENT)
+                case 2:
+                    kind = TK.TK_INT
+                case 3:
+                    kind = symbols[m.group(3)]
+                case _:
+                    kind = TK.TK_INVALID
+            yield Token(Span(start, pos), kind)
+
+        end = len(source)
+        yield Token(Span(end, end), TK.TK_EOF)
+
+
+# `TokenArrays.kinds` stores indices into this list
+TK_KINDS = list(TK)
+TK_INDICES = {kind: index for index, kind in enumerate(TK_KINDS)}
+
+
+@dataclass
+class TokenArrays:
+    """
+    A whole token stream stored as parallel arrays, rather than a `Token` and `Span` per token
+    """
+
+    kinds: array
+    starts: array
+    ends: array
+
+    def __init__(self):
+        self.kinds = array("B")
+        self.starts = array("I")
+        self.ends = array("I")
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    def token(self, index: int) -> Token:
+        span = Span(self.starts[index], self.ends[index])
+        return Token(span, TK_KINDS[self.kinds[index]])
+
+
+def tokenize(source: "str | MappedSource") -> TokenArrays:
+    tokens = TokenArrays()
+    add_kind = tokens.kinds.append
+    add_start = tokens.starts.append
+    add_end = tokens.ends.append
+    buffer, scan_token, keyword_kinds, symbol_kinds = scanner(source)
+    release, release_at = releaser(source)
+    keywords = {word: TK_INDICES[kind] for word, kind in keyword_kinds.items()}
+    symbols = {symbol: TK_INDICES[kind] for symbol, kind in symbol_kinds.items()}
+    ident = TK_INDICES[TK.TK_IDENT]
+    integer = TK_INDICES[TK.TK_INT]
+    invalid = TK_INDICES[TK.TK_INVALID]
+    pos = 0
+
+    while (m := scan_token(buffer, pos)).lastindex is not None:
+        group = m.lastindex
+        start, pos = m.span(group)
+        if pos >= release_at:
+            release(start)
+            release_at = pos + RELEASE_INTERVAL
+        match group:
+            case 1:
+                add_kind(keywords.get(m.group(1), ident))
+            case 2:
+                add_kind(integer)
+            case 3:
+                add_kind(symbols[m.group(3)])
+            case _:
+                add_kind(invalid)
+        add_start(start)
+        add_end(pos)
+
+    add_kind(TK_INDICES[TK.TK_EOF])
+    add_start(len(buffer))
+    add_end(len(buffer))
+    return tokens
@@ -1,58 +1,382 @@
 import argparse
-from interpret import Interpret, NotBound, Ty, TypeMismatch
+import contextlib
+import functools
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Optional
 
+import batch
+import cek
+import cache
+import closure
+import inline
+import memo
+import optimize
+import profiler
+import serialize
+import typecheck
+import vm
+from expr import Expr, RawLetBind
+from interpret import (
+    FunValue,
+    IntTooLarge,
+    Interpret,
+    LimitedInterpret,
+    Limits,
+    NotBound,
+    OutOfFuel,
+    TooDeep,
+    Ty,
+    TypeMismatch,
+    Value,
+)
+
+from lexer import MappedSource
 from parser import Parser, UnexpectedEOI, UnexpectedToken
+from session import Session
+from tracing import DebugTracer, TracingInterpret
+
+
+@dataclass
+class Options:
+    engine: str = "interpret"
+    optimise: bool = False
+    # Inline when this isn't `None`, see `inline.py`
+    inline_budget: Optional[int] = None
+    # Print what `DebugTracer` does, only for the interpret engine
+    trace: bool = False
+    # Print a `profiler.Profiler` report, also only for the interpret engine
+    profile: bool = False
+    # Where to write the profile's collapsed stacks
+    collapsed: Optional[str] = None
+    # Evaluate with `LimitedInterpret` when this isn't `None`
+    limits: Optional[Limits] = None
+    # Remember results of pure functions, up to this many per function, see `memo.py`
+    memo_capacity: Optional[int] = None
+    # Infer types before evaluating, then evaluate without checking them, see `typecheck.py`
+    typecheck: bool = False
+
+    @staticmethod
+    def from_args(args: argparse.Namespace) -> "Options":
+        limits = Limits(args.fuel, args.max_depth, args.max_int_bits)
+        return Options(
+            args.engine,
+            args.optimize,
+            args.inline_budget if args.inline else None,
+            args.trace,
+            args.profile or args.collapsed is not None,
+            args.collapsed,
+            None if limits == Limits() else limits,
+            args.memo_capacity if args.memo else None,
+            args.typecheck,
+        )
+
+    def evaluator(self) -> Callable[[Expr], Value]:
+        if self.limits is not None:
+            limits = self.limits
+            return lambda expr: LimitedInterpret(None, limits).interpret(expr)
+        if self.typecheck and self.engine == "interpret":
+            return lambda expr: typecheck.UncheckedInterpret(None).interpret(expr)
+        return ENGINES[self.engine]
 
 
 def main(args: argparse.Namespace):
     match args.command:
         case "repl":
-            repl()
+            parse_cache = cache.ParseCache(directory=args.cache_dir)
+            repl(Options.from_args(args), parse_cache)
+        case "run" if serialize.is_compiled(args.path):
+            run_compiled(args.path, Options.from_args(args))
+        case "run" if args.mmap:
+            run_mapped(args.path, Options.from_args(args))
         case "run":
             source = open(args.path, "r").read()
-            run(source)
+            parse_cache = cache.ParseCache(directory=args.cache_dir)
+            run(source, Options.from_args(args), parse_cache)
+        case "run-many":
+            paths = expand(args.paths)
+            run_many(paths, Options.from_args(args), args.jobs, args.chunksize)
+        case "batch":
+            source = open(args.path, "r").read()
+            inputs = sys.stdin if args.inputs is None else open(args.inputs, "r")
+            run_batch(source, [int(word) for word in inputs.read().split()])
+        case "compile":
+            source = open(args.path, "r").read()
+            output = args.output or os.path.splitext(args.path)[0] + ".ast"
+            compile_to(source, output)
+        case "disassemble":
+            source = open(args.path, "r").read()
+            disassemble(source)
+
+
+ENGINES: dict[str, Callable[[Expr], Value]] = {
+    "interpret": lambda expr: Interpret(None).interpret(expr),
+    "closure": closure.evaluate,
+    "vm": vm.evaluate,
+    "cek": cek.evaluate,
+}
 
 
-def run(source: str):
-    parser = Parser(source)
+def run(
+    source: str,
+    options: Options = Options(),
+    parse_cache: Optional[cache.ParseCache] = None,
+):
     try:
-        expr = parser.parse_expr()
+        if parse_cache is None:
+            expr = Parser(source).parse_expr()
+        else:
+            expr = parse_cache.parse(source)
+    except Exception as exp:
+        report(exp)
+        return
+
+    evaluate(expr, options, source)
+
+
+def run_compiled(path: str, options: Options = Options()):
+    try:
+        expr = serialize.load(path)
+    except serialize.BadFormat as exp:
+        report(exp)
+        return
+
+    evaluate(expr, options)
+
+
+def run_mapped(path: str, options: Options = Options()):
+    # Lexes the file straight out of memory it's mapped into, rather than reading it first
+    try:
+        with MappedSource(path) as source:
+            expr = Parser(source).parse_expr()
+    except Exception as exp:
+        report(exp)
+        return
+
+    evaluate(expr, options)
+
+
+def evaluate(expr: Expr, options: Options = Options(), source: Optional[str] = None):
+    try:
+        expr = prepare(expr, options)
         print(str(expr))
-        print(Interpret(None).interpret(expr))
+        if options.trace:
+            print(TracingInterpret(None, DebugTracer()).interpret(expr))
+        elif options.profile:
+            value, profile = profiler.profile(expr, source)
+            print(value)
+            print(f"\n{profile.report()}")
+            if options.collapsed is not None:
+                with open(options.collapsed, "w") as file:
+                    file.write(profile.collapsed())
+        elif options.memo_capacity is not None:
+            value, stats = memo.evaluate(expr, options.memo_capacity)
+            print(value)
+            print(f"Memo: {stats}")
+        else:
+            print(options.evaluator()(expr))
+    except Exception as exp:
+        report(exp)
+
+
+def prepare(expr: Expr, options: Options) -> Expr:
+    if options.inline_budget is not None:
+        expr = inline.inline(expr, options.inline_budget)
+    if options.optimise:
+        expr, removed = optimize.optimize(expr)
+        print(f"Optimisation removed {removed} nodes")
+    if options.typecheck:
+        typecheck.infer(expr)
+    return expr
+
+
+# Becomes 1 once an error that isn't one of the language's has been reported, like running out
+# of stack on a deeply nested program, and is then what `main.py` exits with
+exit_status = 0
+
+
+def report(exp: Exception):
+    global exit_status
+    message = describe(exp)
+    if message is None:
+        exit_status = 1
+        message = f"{type(exp).__name__}: {exp}"
+    print(message)
+
+
+def describe(exp: Exception) -> Optional[str]:
+    match exp:
+        case UnexpectedEOI():
+            return "Unexpected end of input"
+        case UnexpectedToken(expected, got):
+            tokens = ", ".join(map(str, expected))
+            return f"Expected {tokens}, got {str(got)}"
+        case NotBound(span):
+            return f"Unbound variable @ {str(span)}"
+        case TypeMismatch(span, e, g):
+            return f"Type mismatch @ {str(span)}: expected {e}, got: {g}"
+        case serialize.BadFormat(reason):
+            return f"Invalid compiled program: {reason}"
+        case OutOfFuel(span):
+            return f"Out of fuel @ {str(span)}"
+        case TooDeep(span, depth):
+            return f"Too deep @ {str(span)}: {depth} calls in progress"
+        case IntTooLarge(span, bits):
+            return f"Integer too large @ {str(span)}: {bits} bits"
+        case typecheck.InfiniteType(span):
+            return f"Infinite type @ {str(span)}"
+    return None
+
+
+def run_file(path: str, options: Options) -> dict:
+    """
+    Runs the program at `path` for `run_many`, returning a JSON-able record of its value or
+    the error it raised, and of what it printed
+
+    Note: This runs in worker processes, so it must stay a top-level function
+    """
+
+    start = time.perf_counter()
+    result: dict = {"path": path}
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            if serialize.is_compiled(path):
+                expr = serialize.load(path)
+            else:
+                expr = Parser(open(path, "r").read()).parse_expr()
+            # Only keep what the program itself prints
+            with contextlib.redirect_stdout(io.StringIO()):
+                expr = prepare(expr, options)
+            result["value"] = show(options.evaluator()(expr))
+        except Exception as exp:
+            result["error"] = type(exp).__name__
+            result["message"] = describe(exp) or str(exp)
+    result["output"] = output.getvalue()
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def expand(patterns: list[str]) -> list[str]:
+    paths = []
+    for pattern in patterns:
+        # A pattern that matches nothing is kept, so it's reported as a missing file
+        paths.extend(sorted(glob.glob(pattern, recursive=True)) or [pattern])
+    return paths
+
+
+def run_many(
+    paths: list[str], options: Options, jobs: Optional[int] = None, chunksize: int = 16
+):
+    # Results are printed as JSON lines as soon as they're ready, in the order of `paths`
+    with ProcessPoolExecutor(jobs) as executor:
+        run = functools.partial(run_file, options=options)
+        for result in executor.map(run, paths, chunksize=chunksize):
+            print(json.dumps(result), flush=True)
+
+
+def run_batch(source: str, args: list[int]):
+    # Prints what applying the program to each of `args` gives, one per line
+    try:
+        expr = Parser(source).parse_expr()
+        f = Interpret(None).interpret(expr)
+        if not isinstance(f, FunValue):
+            raise TypeMismatch(expr.span, Ty.TY_FUN, Ty.TY_INT)
+        results = batch.apply(f, args)
     except Exception as exp:
-        match exp:
-            case UnexpectedEOI():
-                print("Unexpected end of input")
-            case UnexpectedToken(expected, got):
-                tokens = ", ".join(map(str, expected))
-                print(f"Expected {tokens}, got {str(got)}")
-            case NotBound(span):
-                print(f"Unbound variable @ {str(span)}")
-            case TypeMismatch(span, e, g):
-                print(f"Type mismatch @ {str(span)}: expected {e}, got: {g}")
-
-
-def repl():
+        report(exp)
+        return
+
+    print("\n".join(map(show, results)))
+
+
+def compile_to(source: str, path: str):
+    try:
+        serialize.dump(Parser(source).parse_expr(), path)
+    except (UnexpectedEOI, UnexpectedToken) as exp:
+        report(exp)
+
+
+def disassemble(source: str):
+    try:
+        print(vm.disassemble(vm.compile_program(Parser(source).parse_expr())))
+    except (UnexpectedEOI, UnexpectedToken, NotBound) as exp:
+        report(exp)
+
+
+def repl(
+    options: Options = Options(), parse_cache: Optional[cache.ParseCache] = None
+):
+    tracer = DebugTracer() if options.trace else None
+    session = Session(options.engine, parse_cache, tracer)
     try:
         while line := input("$ "):
             if line.startswith(":"):
-                match line[1:]:
-                    case "h" | "help":
+                match line[1:].split(maxsplit=1):
+                    case ["h" | "help"]:
                         print_help()
-                    case "q" | "quit":
+                    case ["q" | "quit"]:
                         exit(0)
+                    case ["time"] if session.timings is None:
+                        print("Nothing has been run yet")
+                    case ["time"]:
+                        print(session.timings)
+                    case ["load", path]:
+                        try:
+                            source = open(path, "r").read()
+                        except OSError as exp:
+                            print(f"Couldn't read {path}: {exp.strerror}")
+                        else:
+                            run_line(session, source, options)
             else:
-                run(line)
+                run_line(session, line, options)
 
     except (KeyboardInterrupt, EOFError):
         exit(1)
 
 
+def run_line(session: Session, source: str, options: Options):
+    try:
+        match session.parse(source):
+            case list(bindings):
+                prepared = [
+                    RawLetBind(
+                        bind.name,
+                        prepare(bind.value, options),
+                        bind.start,
+                        bind.end,
+                    )
+                    for bind in bindings
+                ]
+                for name, value in session.define(prepared):
+                    print(f"{name} = {show(value)}")
+            case expr:
+                expr = prepare(expr, options)
+                print(str(expr))
+                print(session.evaluate(expr))
+    except Exception as exp:
+        report(exp)
+
+
+def show(value: Value) -> str:
+    return "<function value>" if isinstance(value, FunValue) else str(value)
+
+
 def print_help():
     print(
         """Commands:
-    :h/:help - Print this message
-    :q/:quit - Exit the REPL"""
+    :h/:help     - Print this message
+    :q/:quit     - Exit the REPL
+    :time        - Show how long the last line took to lex, parse and evaluate
+    :load <path> - Evaluate a file, keeping any definitions in it
+
+A line starting with `let` and without an `in` defines its bindings for the rest of the
+session, e.g. `let inc = fun n => n + 1`"""
     )
 
 
@@ -65,7 +389,172 @@ if __name__ == "__main__":
     modes = parser.add_subparsers(
         required=True, help="The different modes", dest="command"
     )
-    modes.add_parser("repl")
+    repl_parser = modes.add_parser("repl")
     run_parser = modes.add_parser("run")
-    run_parser.add_argument("path", help="The path of the source file to be run")
-    main(parser.parse_args())
+    run_parser.add_argument(
+        "path", help="The path of the source file, or a compiled one, to be run"
+    )
+    run_many_parser = modes.add_parser("run-many")
+    run_many_parser.add_argument(
+        "paths",
+        nargs="+",
+        metavar="path",
+        help="The paths, or glob patterns, of the programs to run",
+    )
+    run_many_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="How many worker processes to run (default: the number of CPUs)",
+    )
+    run_many_parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=16,
+        help="How many programs to send to a worker at a time (default: 16)",
+    )
+    for mode_parser in [repl_parser, run_parser, run_many_parser]:
+        mode_parser.add_argument(
+            "--engine",
+            choices=ENGINES.keys(),
+            default="interpret",
+            help="The evaluation engine to use",
+        )
+        mode_parser.add_argument(
+            "--optimize",
+            action="store_true",
+            help="Fold constants and drop unused bindings before evaluating",
+        )
+        mode_parser.add_argument(
+            "--inline",
+            action="store_true",
+            help="Inline applications of small let-bound functions before evaluating",
+        )
+        mode_parser.add_argument(
+            "--inline-budget",
+            type=int,
+            default=inline.DEFAULT_BUDGET,
+            metavar="BUDGET",
+            help="With --inline, only inline functions with at most BUDGET nodes"
+            f" (default: {inline.DEFAULT_BUDGET})",
+        )
+    for mode_parser in [repl_parser, run_parser]:
+        mode_parser.add_argument(
+            "--cache-dir",
+            metavar="DIR",
+            help="Also keep parsed programs in DIR, keyed by a hash of their source",
+        )
+        mode_parser.add_argument(
+            "--trace",
+            action="store_true",
+            help="Print every function value as it's made, with the names it captures",
+        )
+    run_parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="Map the source file into memory and lex it as it's parsed, instead of "
+        "reading it all first, for very large programs",
+    )
+    run_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Report where evaluation spends its time, by kind of node and by function",
+    )
+    run_parser.add_argument(
+        "--collapsed",
+        metavar="PATH",
+        help="Also write the profile to PATH as collapsed stacks, for flamegraph tools",
+    )
+    for mode_parser in [run_parser, run_many_parser]:
+        mode_parser.add_argument(
+            "--fuel", type=int, help="Give up after making this many function calls"
+        )
+        mode_parser.add_argument(
+            "--max-depth",
+            type=int,
+            help="Give up when more than this many function calls are in progress",
+        )
+        mode_parser.add_argument(
+            "--max-int-bits",
+            type=int,
+            help="Give up when arithmetic makes an integer with more bits than this",
+        )
+        mode_parser.add_argument(
+            "--typecheck",
+            action="store_true",
+            help="Reject programs that don't type-check, and evaluate the rest faster",
+        )
+    run_parser.add_argument(
+        "--memo",
+        action="store_true",
+        help="Remember what pure functions return for integer arguments, and report the "
+        "hit rate",
+    )
+    run_parser.add_argument(
+        "--memo-capacity",
+        type=int,
+        default=memo.DEFAULT_CAPACITY,
+        metavar="CAPACITY",
+        help="With --memo, remember up to CAPACITY results for each function"
+        f" (default: {memo.DEFAULT_CAPACITY})",
+    )
+    repl_parser.set_defaults(
+        profile=False,
+        collapsed=None,
+        fuel=None,
+        max_depth=None,
+        max_int_bits=None,
+        memo=False,
+        memo_capacity=None,
+        typecheck=False,
+    )
+    run_many_parser.set_defaults(
+        trace=False, profile=False, collapsed=None, memo=False, memo_capacity=None
+    )
+    batch_parser = modes.add_parser("batch")
+    batch_parser.add_argument(
+        "path", help="The path of a source file that evaluates to a function"
+    )
+    batch_parser.add_argument(
+        "inputs",
+        nargs="?",
+        help="A file of integers to apply the function to (default: standard input)",
+    )
+    compile_parser = modes.add_parser("compile")
+    compile_parser.add_argument(
+        "path", help="The path of the source file to be compiled to a binary AST"
+    )
+    compile_parser.add_argument(
+        "-o",
+        "--output",
+        help="Where to write the binary AST (default: the path with a .ast extension)",
+    )
+    disassemble_parser = modes.add_parser("disassemble")
+    disassemble_parser.add_argument(
+        "path", help="The path of the source file to be compiled to bytecode"
+    )
+    args = parser.parse_args()
+    if getattr(args, "trace", False) and args.engine != "interpret":
+        parser.error("--trace only works with --engine interpret")
+    profiling = getattr(args, "profile", False) or getattr(args, "collapsed", None)
+    if profiling and args.engine != "interpret":
+        parser.error("--profile only works with --engine interpret")
+    if profiling and args.trace:
+        parser.error("--profile and --trace can't be used together")
+    limited = any(
+        getattr(args, limit, None) is not None
+        for limit in ["fuel", "max_depth", "max_int_bits"]
+    )
+    if limited and args.engine != "interpret":
+        parser.error("Limits only work with --engine interpret")
+    if limited and (profiling or args.trace):
+        parser.error("Limits can't be used with --profile or --trace")
+    memoising = getattr(args, "memo", False)
+    if memoising and args.engine != "interpret":
+        parser.error("--memo only works with --engine interpret")
+    if memoising and (profiling or args.trace or limited):
+        parser.error("--memo can't be used with --profile, --trace or limits")
+    if args.command == "batch" and batch.np is None:
+        parser.error("batch needs NumPy, which isn't installed")
+    main(args)
+    sys.exit(exit_status)
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from expr import App, BinOp, Expr, Fun, Ident, IntLit, LetIn, Negate, Print
+from interpret import Env, FunValue, Interpret, Value
+from utils import Span, Spanned
+
+DEFAULT_CAPACITY = 256
+
+
+def pure_bodies(expr: Expr) -> set[int]:
+    """
+    The `id`s of the bodies of every `fun` in `expr` that has no `print` in it, since a
+    `FunValue` only keeps its body
+
+    Note: A body with no `print` of its own can still print by applying a function it was
+    passed, so `MemoInterpret` also checks that a call printed nothing before remembering it
+    """
+
+    pure: set[int] = set()
+    prints(expr, pure)
+    return pure
+
+
+def prints(expr: Expr, pure: set[int]) -> bool:
+    # Whether `expr` contains a `print`, adding the pure bodies in it to `pure`
+    match expr:
+        case LetIn(bindings, body):
+            found = prints(body, pure)
+            for bind in bindings:
+                found = prints(bind.value, pure) or found
+            return found
+        case Fun(_, body):
+            found = prints(body, pure)
+            if not found:
+                pure.add(id(body))
+            return found
+        case App(lhs, rhs) | BinOp(_, lhs, rhs):
+            found = prints(lhs, pure)
+            return prints(rhs, pure) or found
+        case Negate(operand):
+            return prints(operand, pure)
+        case Print(value):
+            prints(value, pure)
+            return True
+        case Ident(_) | IntLit(_):
+            return False
+
+    assert False, "unreachable"
+
+
+@dataclass
+class MemoStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+
+class MemoInterpret(Interpret):
+    """
+    An `Interpret` that remembers what pure functions return for integer arguments, in an LRU
+    cache of up to `capacity` results on each `FunValue`
+
+    Note: Evaluation is deterministic and a closure's captures never change, so applying the
+    same `FunValue` to the same integer always gives the same result. Calls that raise, or that
+    printed (by applying some function passed in), aren't remembered
+    """
+
+    pure: set[int]
+    capacity: int
+    stats: MemoStats
+    # How many times `print` has run, to tell whether a call printed
+    printed: int
+
+    def __init__(
+        self, env: Optional[Env], pure: set[int], capacity: int = DEFAULT_CAPACITY
+    ) -> None:
+        super().__init__(env)
+        self.pure = pure
+        self.capacity = capacity
+        self.stats = MemoStats()
+        self.printed = 0
+
+    def fun(self, span: Span, param: Spanned[str], body: Expr) -> Value:
+        value = super().fun(span, param, body)
+        if id(body) in self.pure:
+            value.memo = OrderedDict()  # type: ignore
+        return value
+
+    def call(self, f: FunValue, arg: Value) -> Value:
+        memo = f.memo
+        if memo is None or type(arg) is not int:
+            return super().call(f, arg)
+
+        result = memo.get(arg)
+        if result is not None:
+            memo.move_to_end(arg)
+            self.stats.hits += 1
+            return result
+
+        self.stats.misses += 1
+        printed = self.printed
+        result = super().call(f, arg)
+        if self.printed == printed:
+            memo[arg] = result
+            if len(memo) > self.capacity:
+                memo.popitem(last=False)
+                self.stats.evictions += 1
+        return result
+
+    def printt(self, expr: Expr) -> Value:
+        value = super().printt(expr)
+        self.printed += 1
+        return value
+
+
+def evaluate(expr: Expr, capacity: int = DEFAULT_CAPACITY) -> tuple[Value, MemoStats]:
+    interpret = MemoInterpret(None, pure_bodies(expr), capacity)
+    return interpret.interpret(expr), interpret.stats
@@ -0,0 +1,164 @@
+from dataclasses import replace
+from typing import Any, Generator, Optional
+
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Op,
+    Print,
+    RawLetBind,
+    count_nodes,
+)
+from utils import Spanned, trampoline
+
+# `x op IDENTITY` is just `x`, as long as `x` is an integer
+RIGHT_IDENTITIES = {Op.OP_ADD: 0, Op.OP_SUB: 0, Op.OP_MUL: 1, Op.OP_DIV: 1}
+# Same for `IDENTITY op x`
+LEFT_IDENTITIES = {Op.OP_ADD: 0, Op.OP_MUL: 1}
+
+DIVISIONS = (Op.OP_DIV, Op.OP_MOD)
+
+# Run by `trampoline`, returning the optimized expression along with its free variables
+Steps = Generator["Steps", Any, tuple[Expr, set[str]]]
+
+
+def is_int(expr: Expr) -> bool:
+    # Whatever these evaluate to (if they don't raise) is an integer
+    return type(expr) in (IntLit, BinOp, Negate)
+
+
+def can_drop(value: Expr) -> bool:
+    # Evaluating these can't print, raise or loop, so nobody can tell if we skip them
+    return type(value) in (IntLit, Fun)
+
+
+def respan(expr: Expr, span: Expr) -> Optional[Expr]:
+    # A copy of `expr` with the span of `span`, whose place it takes, unless `expr` can
+    # report an error at its own span, which would then move. A `BinOp` only does when
+    # both operands are functions
+    match expr:
+        case Ident(_):
+            return None
+        case BinOp(_, lhs, rhs) if not (is_int(lhs) or is_int(rhs)):
+            return None
+    return replace(expr, start=span.start, end=span.end)
+
+
+class Optimizer:
+    """
+    Folds constant `BinOp`/`Negate` subtrees, simplifies identities like `x + 0`, `x * 1` and
+    `- - x`, and drops unused `let` bindings that have nothing to evaluate
+
+    Note: Anything that could raise at runtime is left alone, so errors and their spans are the
+    same as for the original program. That means division or modulo by zero isn't folded,
+    identities only apply when `x` is known to be an integer, and a node that takes
+    another's place takes its span too (see `respan`)
+    """
+
+    def optimize(self, expr: Expr) -> tuple[Expr, set[str]]:
+        """
+        Returns the optimized expression along with its free variables
+        """
+
+        return trampoline(self.optimize_steps(expr))
+
+    def optimize_steps(self, expr: Expr) -> Steps:
+        match expr:
+            case LetIn(bindings, body):
+                return (yield self.let_in(expr, bindings, body))
+            case Fun(param, body):
+                body, free = yield self.optimize_steps(body)
+                free.discard(param.data)
+                return Fun(param, body, expr.start, expr.end), free
+            case App(f, arg):
+                f, f_free = yield self.optimize_steps(f)
+                arg, arg_free = yield self.optimize_steps(arg)
+                return App(f, arg, expr.start, expr.end), f_free | arg_free
+            case Negate(operand):
+                operand, free = yield self.optimize_steps(operand)
+                return self.negate(expr, operand), free
+            case BinOp(op, lhs, rhs):
+                lhs, lhs_free = yield self.optimize_steps(lhs)
+                rhs, rhs_free = yield self.optimize_steps(rhs)
+                return self.bin_op(expr, op, lhs, rhs), lhs_free | rhs_free
+            case Print(value):
+                value, free = yield self.optimize_steps(value)
+                return Print(value, expr.start, expr.end), free
+            case Ident(ident):
+                return expr, {ident}
+            case IntLit(_):
+                return expr, set()
+
+        assert False, "unreachable"
+
+    def let_in(self, expr: Expr, bindings: list[RawLetBind], body: Expr) -> Steps:
+        optimized = []
+        for bind in bindings:
+            optimized.append((bind, (yield self.optimize_steps(bind.value))))
+        body, live = yield self.optimize_steps(body)
+
+        # Walk backwards so `live` is always what the rest of the `let` refers to
+        kept: list[RawLetBind] = []
+        for bind, (value, free) in reversed(optimized):
+            name = bind.name.data
+            if name not in live and can_drop(value):
+                continue
+            live.discard(name)
+            live |= free
+            kept.append(RawLetBind(bind.name, value, bind.start, bind.end))
+
+        if not kept:
+            return respan(body, expr) or LetIn([], body, expr.start, expr.end), live
+        kept.reverse()
+        return LetIn(kept, body, expr.start, expr.end), live
+
+    def negate(self, expr: Expr, operand: Expr) -> Expr:
+        match operand:
+            case IntLit(num):
+                return IntLit(-num, expr.start, expr.end)
+            case Negate(inner) if is_int(inner) and (simpler := respan(inner, expr)):
+                return simpler
+            case _:
+                return Negate(operand, expr.start, expr.end)
+
+    def bin_op(self, expr: Expr, op: Spanned[Op], lhs: Expr, rhs: Expr) -> Expr:
+        match (lhs, rhs):
+            case (IntLit(x), IntLit(y)) if not (y == 0 and op.data in DIVISIONS):
+                return IntLit(fold(op.data, x, y), expr.start, expr.end)
+            case (_, IntLit(y)) if is_int(lhs) and RIGHT_IDENTITIES.get(op.data) == y:
+                if simpler := respan(lhs, expr):
+                    return simpler
+            case (IntLit(x), _) if is_int(rhs) and LEFT_IDENTITIES.get(op.data) == x:
+                if simpler := respan(rhs, expr):
+                    return simpler
+        return BinOp(op, lhs, rhs, expr.start, expr.end)
+
+
+def fold(op: Op, x: int, y: int) -> int:
+    # Has to agree with `Interpret.bin_op`
+    match op:
+        case Op.OP_ADD:
+            return x + y
+        case Op.OP_SUB:
+            return x - y
+        case Op.OP_MUL:
+            return x * y
+        case Op.OP_DIV:
+            return x // y
+        case Op.OP_MOD:
+            return x % y
+
+
+def optimize(expr: Expr) -> tuple[Expr, int]:
+    """
+    Returns the optimized expression and how many nodes were removed from it
+    """
+
+    optimized, _ = Optimizer().optimize(expr)
+    return optimized, count_nodes(expr) - count_nodes(optimized)
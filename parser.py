@@ -1,5 +1,5 @@
-from lexer import Lexer, TK, Token
-from utils import Peekable, Spanned
+from lexer import TK_KINDS, FastLexer, MappedSource, TK, Token, TokenArrays, tokenize
+from utils import Peekable, Span, Spanned, trampoline
 from expr import (
     App,
     BinOp,
@@ -14,7 +14,9 @@ from expr import (
     RawLetBind,
 )
 
+import sys
 from dataclasses import dataclass
+from typing import Any, Generator, Optional
 
 
 class SyntaxError(Exception):
@@ -37,27 +39,136 @@ EXPR_TKS = [TK.TK_LET, TK.TK_FUN, TK.TK_PRINT, TK.TK_IDENT, TK.TK_INT, TK.TK_LPA
 
 EXPR_TERMINATORS = [TK.TK_RPAREN, TK.TK_COMMA, TK.TK_IN, TK.TK_EOF]
 
+# A parsing step that can `yield` another step to have it run first, and is sent its result
+Steps = Generator["Steps", Any, Expr]
+
+
+class TokenStream:
+    """
+    Pulls `Token`s from a lexer one at a time
+    """
 
-class Parser:
-    source: str
     lexer: Peekable[Token]
 
-    def __init__(self, source):
+    def __init__(self, lexer: FastLexer):
+        self.lexer = Peekable(lexer)
+
+    def peek(self) -> TK:
+        match self.lexer.peek():
+            case Token(_, kind):
+                return kind
+            case None:
+                return TK.TK_EOF
+
+        assert False, "unreachable"
+
+    def next(self) -> Optional[Token]:
+        return next(self.lexer)
+
+    def next_span(self) -> Optional[Span]:
+        match next(self.lexer):
+            case Token(span, _):
+                return span
+            case None:
+                return None
+
+        assert False, "unreachable"
+
+
+class TokenCursor:
+    """
+    Reads tokens from `TokenArrays` by index, only materialising a `Token` when asked for one
+    (which the parser only does to report an error)
+    """
+
+    tokens: TokenArrays
+    index: int
+
+    def __init__(self, tokens: TokenArrays):
+        self.tokens = tokens
+        self.index = 0
+
+    def peek(self) -> TK:
+        if self.index < len(self.tokens.kinds):
+            return TK_KINDS[self.tokens.kinds[self.index]]
+        else:
+            return TK.TK_EOF
+
+    def next(self) -> Optional[Token]:
+        index = self.index
+        self.index += 1
+        return self.tokens.token(index) if index < len(self.tokens.kinds) else None
+
+    def next_span(self) -> Optional[Span]:
+        index = self.index
+        self.index += 1
+        if index < len(self.tokens.kinds):
+            return Span(self.tokens.starts[index], self.tokens.ends[index])
+        else:
+            return None
+
+
+class Parser:
+    """
+    Recursive descent, except that the recursion goes through generators run by `trampoline`
+    rather than the Python call stack, so nesting depth is only limited by memory
+
+    Note: Where the grammar recurses, the step does `(yield self.parse_subexpr())` instead of
+    calling `self.parse_expr()`
+    """
+
+    # A `MappedSource` is only decoded where identifiers and integers are
+    source: str | MappedSource
+    tokens: TokenStream | TokenCursor
+
+    def __init__(self, source, compact: bool = False, start: int = 0):
         self.source = source
-        self.lexer = Peekable(Lexer(source))
+        if compact:
+            # Tokenize everything up front into `TokenArrays`, which is a lot smaller
+            assert start == 0, "compact parsers always start at the beginning"
+            self.tokens = TokenCursor(tokenize(source))
+        else:
+            # Tokens are only lexed as they're parsed, starting at `start`
+            self.tokens = TokenStream(FastLexer(source, start))
 
     def parse_expr(self) -> Expr:
-        lhs: Expr = self.parse_base_expr()
+        return self.trampoline(self.parse_subexpr())
+
+    def parse_line(self) -> Expr | list[RawLetBind]:
+        """
+        Parses a line of REPL input, which can also be a `let` without an `in` to define its
+        bindings for the rest of the session, in which case they're returned as a list
+        """
+
+        return self.trampoline(self.parse_definitions_or_expr())
+
+    def parse_definitions_or_expr(self) -> Steps:
+        if self.peek() != TK.TK_LET:
+            return (yield self.parse_subexpr())
+
+        let = self.next_span()
+        bindings = yield self.parse_bindings()
+        if self.peek() == TK.TK_EOF:
+            return bindings
+
+        # Just an ordinary `let` after all, its body extends as far as an operand could
+        return (yield self.parse_let_body(let, bindings))
+
+    def trampoline(self, steps: Steps) -> Expr:
+        return trampoline(steps)
+
+    def parse_subexpr(self) -> Steps:
+        lhs: Expr = yield self.parse_base_expr()
 
         while True:
             peeked = self.peek()
             if peeked in BINOP_TKS:
-                op = self.next().map_data(Op.from_tk)
-                rhs = self.parse_base_expr_or_unary_op()
-                lhs = Spanned(span=lhs.span + rhs.span, data=BinOp(op, lhs, rhs))
+                op = Spanned(span=self.next_span(), data=Op.from_tk(peeked))
+                rhs = yield self.parse_base_expr_or_unary_op()
+                lhs = BinOp(op, lhs, rhs, start=lhs.start, end=rhs.end)
             elif peeked in EXPR_TKS:
-                arg = self.parse_base_expr()
-                lhs = Spanned(span=lhs.span + arg.span, data=App(f=lhs, arg=arg))
+                arg = yield self.parse_base_expr()
+                lhs = App(f=lhs, arg=arg, start=lhs.start, end=arg.end)
             elif peeked in EXPR_TERMINATORS:
                 break
             else:
@@ -67,104 +178,110 @@ class Parser:
 
         return lhs
 
-    def parse_base_expr_or_unary_op(self):
+    def parse_base_expr_or_unary_op(self) -> Steps:
         # Could generalise this to other prefix unary operators like boolean negation
         if self.peek() == TK.TK_SUB:
-            return self.parse_negation()
+            return (yield self.parse_negation())
         else:
-            return self.parse_base_expr()
+            return (yield self.parse_base_expr())
 
-    def parse_base_expr(self) -> Expr:
+    def parse_base_expr(self) -> Steps:
         match self.peek():
             case TK.TK_LET:
-                return self.parse_let()
+                return (yield self.parse_let())
             case TK.TK_FUN:
-                return self.parse_fun()
+                return (yield self.parse_fun())
             case TK.TK_PRINT:
-                return self.parse_print()
+                return (yield self.parse_print())
             case TK.TK_IDENT:
                 return self.parse_ident()
             case TK.TK_INT:
                 return self.parse_int()
             case TK.TK_LPAREN:
-                lparen = self.next()
-                expr = self.parse_expr()
+                lparen = self.next_span()
+                expr = yield self.parse_subexpr()
                 rparen = self.expect(TK.TK_RPAREN)
-                return Spanned(span=lparen.span + rparen.span, data=expr.data)
+                # The parentheses become part of the expression's span
+                expr.start, expr.end = lparen.start, rparen.end
+                return expr
             case _:
                 raise UnexpectedToken(
                     expected=EXPR_TKS,
                     got=self.next(),
                 )
 
-    def parse_negation(self) -> Expr:
-        minus = self.next()
-        operand = self.parse_base_expr()
-        return Spanned(span=minus.span + operand.span, data=Negate(operand))
+    def parse_negation(self) -> Steps:
+        minus = self.next_span()
+        operand = yield self.parse_base_expr()
+        return Negate(operand, start=minus.start, end=operand.end)
+
+    def parse_let(self) -> Steps:
+        let = self.next_span()
+        bindings = yield self.parse_bindings()
+        return (yield self.parse_let_body(let, bindings))
 
-    def parse_let(self) -> Expr:
-        let = self.next()
+    def parse_bindings(self) -> Steps:
         bindings = []
         while self.peek() != TK.TK_IN:
-            name = self.token_source(self.expect(TK.TK_IDENT))
-            self.expect(TK.TK_ASSIGN)
-            value = self.parse_expr()
-            bind = RawLetBind(name, value)
-            bindings.append(Spanned(span=name.span + value.span, data=bind))
+            bindings.append((yield self.parse_binding()))
 
             if self.peek() == TK.TK_COMMA:
-                self.next()
+                self.next_span()
             else:
                 break
 
+        return bindings
+
+    def parse_binding(self) -> Steps:
+        name = self.expect_source(TK.TK_IDENT)
+        self.expect(TK.TK_ASSIGN)
+        value = yield self.parse_subexpr()
+        return RawLetBind(name, value, start=name.span.start, end=value.end)
+
+    def parse_let_body(self, let: Span, bindings: list[RawLetBind]) -> Steps:
         self.expect(TK.TK_IN)
-        body = self.parse_expr()
+        body = yield self.parse_subexpr()
 
-        return Spanned(span=let.span + body.span, data=LetIn(bindings, body))
+        return LetIn(bindings, body, start=let.start, end=body.end)
 
-    def parse_fun(self) -> Expr:
-        fun = self.next()
+    def parse_fun(self) -> Steps:
+        fun = self.next_span()
 
         params: list[Spanned[str]] = []
         while self.peek() != TK.TK_ARROW:
-            name = self.token_source(self.expect(TK.TK_IDENT))
+            name = self.expect_source(TK.TK_IDENT)
             params.append(name)
 
         self.expect(TK.TK_ARROW)
         # We do a little bit of auto-currying
-        body: Expr = self.parse_expr()
+        body: Expr = yield self.parse_subexpr()
         first_param, *rest_params = params
         for param in reversed(rest_params):
-            body = Spanned(span=param.span + body.span, data=Fun(param, body))
+            body = Fun(param, body, start=param.span.start, end=body.end)
 
-        return Spanned(
-            span=fun.span + body.span, data=Fun(param=first_param, body=body)
-        )
+        return Fun(param=first_param, body=body, start=fun.start, end=body.end)
 
-    def parse_print(self) -> Expr:
-        print_kw = self.next()
-        value = self.parse_expr()
-        return Spanned(span=print_kw.span + value.span, data=Print(value))
+    def parse_print(self) -> Steps:
+        print_kw = self.next_span()
+        value = yield self.parse_subexpr()
+        return Print(value, start=print_kw.start, end=value.end)
 
     def parse_ident(self) -> Expr:
-        ident = self.next()
-        return Spanned(span=ident.span, data=Ident(self.token_source(ident).data))
+        span = self.next_span()
+        # Interned so repeated uses of a name share one string
+        ident = sys.intern(self.source[span.start : span.end])
+        return Ident(ident, start=span.start, end=span.end)
 
     def parse_int(self) -> Expr:
-        num = self.token_source(self.next())
-        return Spanned(span=num.span, data=IntLit(int(num.data)))
+        span = self.next_span()
+        num = int(self.source[span.start : span.end])
+        return IntLit(num, start=span.start, end=span.end)
 
     def peek(self) -> TK:
-        match self.lexer.peek():
-            case Token(_, kind):
-                return kind
-            case None:
-                return TK.TK_EOF
-
-        assert False, "unreachable"
+        return self.tokens.peek()
 
     def next(self) -> Token:
-        match next(self.lexer):
+        match self.tokens.next():
             case None:
                 raise UnexpectedEOI()
             case Token(_, _) as tok:
@@ -172,10 +289,19 @@ class Parser:
 
         assert False, "unreachable"
 
-    def expect(self, expected: TK) -> Token:
+    def next_span(self) -> Span:
+        match self.tokens.next_span():
+            case None:
+                raise UnexpectedEOI()
+            case Span() as span:
+                return span
+
+        assert False, "unreachable"
+
+    def expect(self, expected: TK) -> Span:
         match self.peek():
             case kind if kind == expected:
-                return self.next()
+                return self.next_span()
             case TK.TK_EOF:
                 raise UnexpectedEOI()
             case _:
@@ -183,5 +309,6 @@ class Parser:
 
         assert False, "unreachable"
 
-    def token_source(self, tok: Token) -> Spanned[str]:
-        return tok.get_source(self.source)
+    def expect_source(self, expected: TK) -> Spanned[str]:
+        span = self.expect(expected)
+        return Spanned(span=span, data=self.source[span.start : span.end])
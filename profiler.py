@@ -0,0 +1,183 @@
+from bisect import bisect_right
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Optional
+
+from expr import Expr
+from interpret import Env, FunValue, Value
+from tracing import Tracer, TracingInterpret
+from utils import Span
+
+# The frame at the bottom of every collapsed stack
+ROOT = "<program>"
+
+
+@dataclass(slots=True)
+class Stats:
+    count: int = 0
+    # Including the time spent in nested nodes or calls
+    total: float = 0
+    # Excluding it
+    own: float = 0
+
+
+class Lines:
+    """
+    Turns offsets into a source string into 1-based line and column numbers
+    """
+
+    starts: list[int]
+
+    def __init__(self, source: str) -> None:
+        self.starts = [0]
+        self.starts.extend(i + 1 for i, char in enumerate(source) if char == "\n")
+
+    def location(self, offset: int) -> str:
+        line = bisect_right(self.starts, offset)
+        return f"{line}:{offset - self.starts[line - 1] + 1}"
+
+
+class Profiler(Tracer):
+    """
+    Counts evaluations and time spent per kind of node, and calls and time spent per function,
+    keeping the self time of every stack of functions for `collapsed`
+
+    Note: Each of `enter`/`exit` and `call`/`ret` reads the clock once and touches a couple of
+    lists and dicts, so the overhead stays around 2x. A function is keyed by the span of the
+    `fun` that made it, so every closure made by the same `fun` counts towards the same entry
+    """
+
+    kinds: dict[str, Stats]
+    funs: dict[tuple[int, int], Stats]
+    # `FunValue`s only keep their body, this finds the span and label of the `fun` it came from
+    fun_spans: dict[int, tuple[tuple[int, int], str]]
+    labels: dict[tuple[int, int], str]
+    stacks: dict[tuple[str, ...], float]
+    # One entry per node being evaluated: its start and the time spent in its children
+    node_starts: list[float]
+    node_children: list[float]
+    # One entry per call being evaluated, with `calls[0]` for the whole program
+    calls: list[tuple[tuple[str, ...], tuple[int, int], float]]
+    call_children: list[float]
+    # How many of each kind of node and function are being evaluated, so `total` only counts
+    # the outermost of them and nested ones aren't counted twice
+    active: dict[str | tuple[int, int], int]
+    lines: Optional[Lines]
+
+    def __init__(self, source: Optional[str] = None) -> None:
+        self.kinds = {}
+        self.funs = {}
+        self.fun_spans = {}
+        self.labels = {}
+        self.stacks = {}
+        self.node_starts = []
+        self.node_children = []
+        self.calls = []
+        self.call_children = []
+        self.active = {}
+        self.lines = None if source is None else Lines(source)
+        self.calls.append(((ROOT,), (0, 0), perf_counter()))
+        self.call_children.append(0)
+
+    def stop(self) -> None:
+        # Records the time spent outside of any function, call it once evaluation finishes
+        stack, _, start = self.calls.pop()
+        elapsed = perf_counter() - start
+        self.stacks[stack] = self.stacks.get(stack, 0) + (
+            elapsed - self.call_children.pop()
+        )
+
+    def enter(self, expr: Expr, env: Env) -> None:
+        kind = type(expr).__name__
+        self.active[kind] = self.active.get(kind, 0) + 1
+        self.node_children.append(0)
+        self.node_starts.append(perf_counter())
+
+    def exit(self, expr: Expr, value: Value) -> None:
+        elapsed = perf_counter() - self.node_starts.pop()
+        children = self.node_children.pop()
+        if self.node_children:
+            self.node_children[-1] += elapsed
+
+        kind = type(expr).__name__
+        stats = self.kinds.get(kind)
+        if stats is None:
+            stats = self.kinds[kind] = Stats()
+        stats.count += 1
+        stats.own += elapsed - children
+        self.active[kind] -= 1
+        if self.active[kind] == 0:
+            stats.total += elapsed
+
+    def fun(self, span: Span, value: FunValue, frame: Env) -> None:
+        if id(value.body) not in self.fun_spans:
+            key = (span.start, span.end)
+            label = f"fun {value.param.data} @ {self.location(span.start)}"
+            self.fun_spans[id(value.body)] = key, label
+            self.labels[key] = label
+
+    def call(self, f: FunValue, arg: Value) -> None:
+        key, label = self.fun_spans[id(f.body)]
+        self.active[key] = self.active.get(key, 0) + 1
+        stack = self.calls[-1][0] + (label,)
+        self.call_children.append(0)
+        self.calls.append((stack, key, perf_counter()))
+
+    def ret(self, f: FunValue, result: Value) -> None:
+        stack, key, start = self.calls.pop()
+        elapsed = perf_counter() - start
+        children = self.call_children.pop()
+        self.call_children[-1] += elapsed
+        self.stacks[stack] = self.stacks.get(stack, 0) + (elapsed - children)
+
+        stats = self.funs.get(key)
+        if stats is None:
+            stats = self.funs[key] = Stats()
+        stats.count += 1
+        stats.own += elapsed - children
+        self.active[key] -= 1
+        if self.active[key] == 0:
+            stats.total += elapsed
+
+    def location(self, offset: int) -> str:
+        return str(offset) if self.lines is None else self.lines.location(offset)
+
+    def report(self, limit: int = 20) -> str:
+        rows = [f"{'node': <12} {'count': >10} {'total': >12} {'self': >12}"]
+        for kind, stats in sorted(self.kinds.items(), key=lambda item: -item[1].own):
+            rows.append(
+                f"{kind: <12} {stats.count: >10} {stats.total * 1000:9.3f} ms "
+                f"{stats.own * 1000:9.3f} ms"
+            )
+
+        rows.append(
+            f"\n{'function': <32} {'calls': >10} {'total': >12} {'self': >12}"
+        )
+        funs = sorted(self.funs.items(), key=lambda item: -item[1].own)
+        for key, stats in funs[:limit]:
+            label = f"{self.labels[key]}-{self.location(key[1])}"
+            rows.append(
+                f"{label: <32} {stats.count: >10} {stats.total * 1000:9.3f} ms "
+                f"{stats.own * 1000:9.3f} ms"
+            )
+        if len(funs) > limit:
+            rows.append(f"... and {len(funs) - limit} more")
+        return "\n".join(rows)
+
+    def collapsed(self) -> str:
+        """
+        The self time of every stack of calls in the collapsed format that flamegraph tools
+        read: one line per stack, with its frames separated by `;` followed by microseconds
+        """
+
+        return "".join(
+            f"{';'.join(stack)} {round(seconds * 1_000_000)}\n"
+            for stack, seconds in self.stacks.items()
+        )
+
+
+def profile(expr: Expr, source: Optional[str] = None) -> tuple[Value, Profiler]:
+    profiler = Profiler(source)
+    value = TracingInterpret(None, profiler).interpret(expr)
+    profiler.stop()
+    return value, profiler
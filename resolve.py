@@ -0,0 +1,98 @@
+from typing import Any, Generator, Optional
+
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Print,
+    RawLetBind,
+)
+from interpret import NotBound
+from utils import Span, Spanned, trampoline
+
+# Maps a name to its slot in the corresponding `Frame`
+Scope = dict[str, int]
+
+# Run by `trampoline`, so deeply nested programs don't overflow the Python stack
+Steps = Generator["Steps", Any, None]
+
+
+class Resolver:
+    """
+    Annotates every `Ident` with a lexical address (`depth` frames out, `slot` within that frame)
+    so evaluators can use an array-backed `Frame` instead of walking an `Env` by name
+
+    Note: Unbound variables are reported here as `NotBound`, before anything is evaluated
+    """
+
+    scopes: list[Scope]
+
+    def __init__(self, scopes: Optional[list[Scope]] = None) -> None:
+        self.scopes = [] if scopes is None else scopes
+
+    def resolve(self, expr: Expr) -> None:
+        trampoline(self.resolve_steps(expr))
+
+    def resolve_steps(self, expr: Expr) -> Steps:
+        match expr.data:
+            case LetIn(bindings, body):
+                yield self.let_in(bindings, body)
+            case Fun(param, body):
+                yield self.fun(param, body)
+            case App(f, arg):
+                yield self.resolve_steps(f)
+                yield self.resolve_steps(arg)
+            case Negate(operand):
+                yield self.resolve_steps(operand)
+            case BinOp(_, lhs, rhs):
+                yield self.resolve_steps(lhs)
+                yield self.resolve_steps(rhs)
+            case Print(value):
+                yield self.resolve_steps(value)
+            case Ident(_) as ident:
+                self.ident(expr.span, ident)
+            case IntLit(_):
+                pass
+            case _:
+                assert False, "unreachable"
+
+    def let_in(self, bindings: list[RawLetBind], body: Expr) -> Steps:
+        # Every binding gets its own slot, even when it shadows an earlier one in the same
+        # `let`, so closures capturing the earlier binding still see the earlier value
+        scope: Scope = {}
+        self.scopes.append(scope)
+        for slot, bind in enumerate(bindings, start=1):
+            yield self.resolve_steps(bind.value)
+            bind.slot = slot
+            scope[bind.name.data] = slot
+        yield self.resolve_steps(body)
+        self.scopes.pop()
+
+    def fun(self, param: Spanned[str], body: Expr) -> Steps:
+        self.scopes.append({param.data: 1})
+        yield self.resolve_steps(body)
+        self.scopes.pop()
+
+    def ident(self, span: Span, ident: Ident) -> None:
+        for depth, scope in enumerate(reversed(self.scopes)):
+            if (slot := scope.get(ident.ident)) is not None:
+                ident.depth = depth
+                ident.slot = slot
+                return
+
+        raise NotBound(span)
+
+
+def resolve(expr: Expr, globals: Optional[Scope] = None) -> Expr:
+    """
+    Resolves `expr`, with `globals` as the outermost scope if it's given, in which case it
+    has to be evaluated in a `Frame` with those slots
+    """
+
+    Resolver(None if globals is None else [globals]).resolve(expr)
+    return expr
@@ -0,0 +1,337 @@
+import mmap
+import sys
+from dataclasses import dataclass
+from typing import Any
+
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Node,
+    Op,
+    Print,
+    RawLetBind,
+    children,
+)
+from utils import Span, Spanned
+
+MAGIC = b"FUNAST"
+VERSION = 1
+
+# Every node is written after its children (postorder), so a reader can rebuild the tree with
+# a stack instead of recursion. Each record is a tag byte followed by the fields listed, then
+# the node's span, then the span of its name or operator if it has one.
+#
+# Spans are stored relative to something nearby so the varints stay short: a leaf's start is
+# relative to the end of the previous record and its end to its start, other nodes' starts are
+# relative to their first child's start and their ends to their last child's end. A name is
+# relative to the node's start and an operator to the end of its lhs
+TAG_INT = 0  # zigzag varint
+TAG_IDENT = 1  # ident index
+TAG_FUN = 2  # param ident index            pops the body
+TAG_APP = 3  #                              pops the argument and function
+TAG_NEGATE = 4  #                           pops the operand
+TAG_PRINT = 5  #                            pops the value
+TAG_BINOP = 6  # op index                   pops the rhs and lhs
+TAG_LET_BIND = 7  # name ident index        pops the value
+TAG_LET = 8  # binding count                pops the body and bindings
+
+OPS = list(Op)
+OP_INDICES = {op: index for index, op in enumerate(OPS)}
+
+
+@dataclass
+class BadFormat(Exception):
+    reason: str
+
+
+def first_and_last(node: Expr | RawLetBind) -> tuple[Node, Node]:
+    match node:
+        case LetIn(bindings, body):
+            return (bindings[0] if bindings else body), body
+        case RawLetBind(_, value) | Fun(_, value) | Negate(value) | Print(value):
+            return value, value
+        case App(lhs, rhs) | BinOp(_, lhs, rhs):
+            return lhs, rhs
+
+    assert False, "unreachable"
+
+
+class Encoder:
+    """
+    Writes an `Expr` in the binary format described above, see `dumps`
+    """
+
+    out: bytearray
+    idents: dict[str, int]
+    last_end: int
+
+    def __init__(self) -> None:
+        self.out = bytearray()
+        self.idents = {}
+        self.last_end = 0
+
+    def encode(self, expr: Expr) -> bytes:
+        # Reversing a preorder walk that visits the last child first gives a postorder
+        order: list[Expr | RawLetBind] = []
+        pending: list[Expr | RawLetBind] = [expr]
+        while pending:
+            node = pending.pop()
+            order.append(node)
+            match node:
+                case LetIn(bindings, body):
+                    pending.extend(bindings)
+                    pending.append(body)
+                case RawLetBind(_, value):
+                    pending.append(value)
+                case _:
+                    pending.extend(children(node))
+
+        for node in reversed(order):
+            self.node(node)
+
+        header = bytearray(MAGIC)
+        header.append(VERSION)
+        write_uint(header, len(self.idents))
+        for ident in self.idents:
+            encoded = ident.encode()
+            write_uint(header, len(encoded))
+            header += encoded
+        return bytes(header + self.out)
+
+    def node(self, node: Expr | RawLetBind) -> None:
+        out = self.out
+        match node:
+            case IntLit(num):
+                out.append(TAG_INT)
+                write_int(out, num)
+            case Ident(ident):
+                out.append(TAG_IDENT)
+                write_uint(out, self.ident(ident))
+            case Fun(param, _):
+                out.append(TAG_FUN)
+                write_uint(out, self.ident(param.data))
+            case App(_, _):
+                out.append(TAG_APP)
+            case Negate(_):
+                out.append(TAG_NEGATE)
+            case Print(_):
+                out.append(TAG_PRINT)
+            case BinOp(op, _, _):
+                out.append(TAG_BINOP)
+                out.append(OP_INDICES[op.data])
+            case RawLetBind(name, _):
+                out.append(TAG_LET_BIND)
+                write_uint(out, self.ident(name.data))
+            case LetIn(bindings, _):
+                out.append(TAG_LET)
+                write_uint(out, len(bindings))
+            case _:
+                assert False, "unreachable"
+
+        if isinstance(node, (IntLit, Ident)):
+            write_int(out, node.start - self.last_end)
+            write_uint(out, node.end - node.start)
+        else:
+            first, last = first_and_last(node)
+            write_int(out, first.start - node.start)
+            write_int(out, node.end - last.end)
+        self.last_end = node.end
+
+        match node:
+            case Fun(name, _) | RawLetBind(name, _):
+                write_int(out, name.span.start - node.start)
+                write_uint(out, name.span.end - name.span.start)
+            case BinOp(op, lhs, _):
+                write_int(out, op.span.start - lhs.end)
+                write_uint(out, op.span.end - op.span.start)
+
+    def ident(self, ident: str) -> int:
+        index = self.idents.get(ident)
+        if index is None:
+            index = self.idents[ident] = len(self.idents)
+        return index
+
+
+def write_uint(out: bytearray, n: int) -> None:
+    # LEB128: seven bits per byte, least significant first, high bit set on all but the last
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def write_int(out: bytearray, n: int) -> None:
+    # Zigzag, so small negative numbers stay small
+    write_uint(out, n * 2 if n >= 0 else -n * 2 - 1)
+
+
+class Decoder:
+    """
+    Reads an `Expr` back from anything indexable as bytes, such as an `mmap`, without copying
+    more than each identifier out of it
+    """
+
+    buffer: Any
+    pos: int
+
+    def __init__(self, buffer: Any) -> None:
+        self.buffer = buffer
+        self.pos = 0
+
+    def uint(self) -> int:
+        buffer = self.buffer
+        pos = self.pos
+        byte = buffer[pos]
+        n = byte & 0x7F
+        shift = 7
+        pos += 1
+        while byte & 0x80:
+            byte = buffer[pos]
+            n |= (byte & 0x7F) << shift
+            shift += 7
+            pos += 1
+        self.pos = pos
+        return n
+
+    def int(self) -> int:
+        n = self.uint()
+        return n >> 1 if n & 1 == 0 else -(n >> 1) - 1
+
+    def span(self, start: int) -> Span:
+        start += self.int()
+        return Span(start, start + self.uint())
+
+    def decode(self) -> Expr:
+        buffer = self.buffer
+        if buffer[: len(MAGIC)] != MAGIC:
+            raise BadFormat("not a compiled program")
+        if buffer[len(MAGIC)] != VERSION:
+            raise BadFormat(f"unsupported version {buffer[len(MAGIC)]}")
+        self.pos = len(MAGIC) + 1
+
+        uint = self.uint
+        int_ = self.int
+        idents = []
+        for _ in range(uint()):
+            length = uint()
+            ident = str(buffer[self.pos : self.pos + length], "utf-8")
+            idents.append(sys.intern(ident))
+            self.pos += length
+
+        stack: list[Any] = []
+        push = stack.append
+        pop = stack.pop
+        size = len(buffer)
+        end = 0
+        while self.pos < size:
+            tag = buffer[self.pos]
+            self.pos += 1
+            if tag == TAG_IDENT:
+                ident = idents[uint()]
+                start = end + int_()
+                end = start + uint()
+                push(Ident(ident, start, end))
+            elif tag == TAG_INT:
+                num = int_()
+                start = end + int_()
+                end = start + uint()
+                push(IntLit(num, start, end))
+            elif tag == TAG_APP:
+                arg = pop()
+                f = pop()
+                start = f.start - int_()
+                end = arg.end + int_()
+                push(App(f, arg, start, end))
+            elif tag == TAG_BINOP:
+                op = OPS[buffer[self.pos]]
+                self.pos += 1
+                rhs = pop()
+                lhs = pop()
+                start = lhs.start - int_()
+                end = rhs.end + int_()
+                push(BinOp(Spanned(self.span(lhs.end), op), lhs, rhs, start, end))
+            elif tag == TAG_FUN:
+                ident = idents[uint()]
+                body = pop()
+                start = body.start - int_()
+                end = body.end + int_()
+                param = Spanned(self.span(start), ident)
+                push(Fun(param, body, start, end))
+            elif tag == TAG_LET_BIND:
+                ident = idents[uint()]
+                value = pop()
+                start = value.start - int_()
+                end = value.end + int_()
+                name = Spanned(self.span(start), ident)
+                push(RawLetBind(name, value, start, end))
+            elif tag == TAG_LET:
+                count = uint()
+                body = pop()
+                if count > len(stack):
+                    raise BadFormat(f"{count} bindings but {len(stack)} nodes")
+                bindings = stack[len(stack) - count :]
+                del stack[len(stack) - count :]
+                start = (bindings[0] if bindings else body).start - int_()
+                end = body.end + int_()
+                push(LetIn(bindings, body, start, end))
+            elif tag == TAG_NEGATE:
+                operand = pop()
+                start = operand.start - int_()
+                end = operand.end + int_()
+                push(Negate(operand, start, end))
+            elif tag == TAG_PRINT:
+                value = pop()
+                start = value.start - int_()
+                end = value.end + int_()
+                push(Print(value, start, end))
+            else:
+                raise BadFormat(f"unknown tag {tag}")
+
+        if len(stack) != 1:
+            raise BadFormat("truncated program")
+        return stack[0]
+
+
+def dumps(expr: Expr) -> bytes:
+    return Encoder().encode(expr)
+
+
+def loads(buffer: Any) -> Expr:
+    try:
+        return Decoder(buffer).decode()
+    except IndexError:
+        raise BadFormat("truncated program")
+    except ValueError as exp:
+        # Such as an identifier that isn't valid UTF-8
+        raise BadFormat(str(exp))
+
+
+def dump(expr: Expr, path: str) -> None:
+    with open(path, "wb") as file:
+        file.write(dumps(expr))
+
+
+def load(path: str) -> Expr:
+    """
+    Memory-maps the file at `path` and decodes it in place
+    """
+
+    with open(path, "rb") as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # `mmap` refuses empty files
+            raise BadFormat("not a compiled program")
+    with buffer:
+        return loads(buffer)
+
+
+def is_compiled(path: str) -> bool:
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
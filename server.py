@@ -0,0 +1,300 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from expr import Expr, Op
+from interpret import FunValue, Interpret, LimitedInterpret, Limits, Value
+from main import describe, show
+from parser import Parser
+from utils import Span, Spanned
+
+DEFAULT_TIMEOUT = 5.0
+
+# Programs can square integers without making any calls, and each squaring takes longer
+# than the last, so the server always limits their size
+DEFAULT_INT_BITS = 2**20
+
+# How many calls `DeadlineInterpret` makes between looking at the clock
+CLOCK_INTERVAL = 1024
+
+# Requests and responses are JSON objects, one per line:
+#
+#   {"id": 1, "source": "1 + 2", "timeout": 1.5, "fuel": 10000, "depth": 100, "int_bits": 64}
+#   {"id": 1, "value": "3", "output": ""}
+#   {"id": 1, "error": "NotBound", "message": "Unbound variable @ 0..1", "output": ""}
+#
+# Everything but "source" is optional, the timeout and limits (see `interpret.Limits`) can
+# only be lower than the server's, which they default to, and "id" is only echoed back so a
+# client can send more than one request at a time on a connection, since responses are
+# written as they finish
+
+
+@dataclass
+class Timeout(RuntimeError):
+    span: Span
+
+
+class DeadlineInterpret(LimitedInterpret):
+    """
+    A `LimitedInterpret` that also gives up once `deadline` (from `time.monotonic`) passes
+
+    Note: A process pool can't cancel a call that's already running, so the worker has to give
+    up by itself when the server stops waiting for it. Programs without calls can still take
+    a long time over a few operations on huge integers, so the clock is read before every one
+    """
+
+    deadline: float
+
+    def __init__(self, limits: Limits, deadline: float) -> None:
+        super().__init__(None, limits)
+        self.deadline = deadline
+
+    def call(self, f: FunValue, arg: Value) -> Value:
+        if self.fuel % CLOCK_INTERVAL == 0 and time.monotonic() > self.deadline:
+            raise Timeout(f.body.span)
+        return super().call(f, arg)
+
+    def bin_op(self, span: Span, op: Spanned[Op], lhs: Expr, rhs: Expr) -> Value:
+        if time.monotonic() > self.deadline:
+            raise Timeout(span)
+        return super().bin_op(span, op, lhs, rhs)
+
+
+def evaluate(source: str, limits: Limits, timeout: float) -> dict:
+    # Runs in a worker process, so only plain data goes in and out
+    response: dict = {}
+    with contextlib.redirect_stdout(io.StringIO()) as output:
+        try:
+            expr = Parser(source).parse_expr()
+            interpret = DeadlineInterpret(limits, time.monotonic() + timeout)
+            response["value"] = show(interpret.interpret(expr))
+        except Exception as exp:
+            response["error"] = type(exp).__name__
+            response["message"] = message(exp)
+    response["output"] = output.getvalue()
+    return response
+
+
+def message(exp: Exception) -> str:
+    match exp:
+        case Timeout(span):
+            return f"Timed out @ {str(span)}"
+    return describe(exp) or str(exp)
+
+
+def warm_up() -> None:
+    # Makes the pool start its workers, and them import everything, before the first request
+    Interpret(None).interpret(Parser("1").parse_expr())
+
+
+class Server:
+    """
+    Reads requests off connections with asyncio and evaluates them on a pool of processes, so
+    evaluating one program never holds up accepting or answering others
+    """
+
+    pool: ProcessPoolExecutor
+    timeout: float
+    limits: Limits
+
+    def __init__(
+        self, pool: ProcessPoolExecutor, timeout: float, limits: Limits
+    ) -> None:
+        self.pool = pool
+        self.timeout = timeout
+        self.limits = limits
+
+    async def connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        pending = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self.respond(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            await asyncio.gather(*pending)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, line: bytes, writer: asyncio.StreamWriter) -> None:
+        response = await self.handle(line)
+        writer.write(json.dumps(response).encode() + b"\n")
+        await writer.drain()
+
+    async def handle(self, line: bytes) -> dict:
+        request = None
+        try:
+            request = json.loads(line)
+            source = request["source"]
+            # Requests can lower the server's limits, but not raise them
+            timeout = float(request.get("timeout", self.timeout))
+            # `json.loads` accepts `NaN`, which no deadline is ever later than
+            if not (math.isfinite(timeout) and timeout >= 0):
+                raise ValueError(f"invalid timeout {timeout}")
+            timeout = min(timeout, self.timeout)
+            limits = Limits(
+                lower(request.get("fuel"), self.limits.fuel),
+                lower(request.get("depth"), self.limits.depth),
+                lower(request.get("int_bits"), self.limits.int_bits),
+            )
+        except (ValueError, TypeError, KeyError, OverflowError) as exp:
+            id = request.get("id") if isinstance(request, dict) else None
+            return {"id": id, "error": "BadRequest", "message": str(exp)}
+
+        response = {"id": request.get("id")}
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self.pool, evaluate, source, limits, timeout)
+        try:
+            # A little longer than the worker's own deadline, which it only checks now and then
+            response |= await asyncio.wait_for(call, timeout * 2)
+        except asyncio.TimeoutError:
+            response |= {"error": "Timeout", "message": f"No result after {timeout}s"}
+        return response
+
+
+def lower(requested: Optional[int], limit: Optional[int]) -> Optional[int]:
+    # The lower of two limits, where `None` is no limit
+    if requested is None or limit is None:
+        return limit if requested is None else int(requested)
+    return min(int(requested), limit)
+
+
+async def serve(args: argparse.Namespace) -> None:
+    workers = args.jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(loop.run_in_executor(pool, warm_up) for _ in range(workers))
+        )
+
+        limits = Limits(args.fuel, args.max_depth, args.max_int_bits)
+        server = Server(pool, args.timeout, limits)
+        if args.socket is not None:
+            listener = await asyncio.start_unix_server(server.connection, args.socket)
+        else:
+            listener = await asyncio.start_server(
+                server.connection, args.host, args.port
+            )
+        async with listener:
+            for socket in listener.sockets:
+                print(f"Listening on {socket.getsockname()} with {workers} workers")
+            await listener.serve_forever()
+
+
+async def connect(
+    args: argparse.Namespace,
+) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if args.socket is not None:
+        return await asyncio.open_unix_connection(args.socket)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def client(args: argparse.Namespace, source: str, latencies: list[float]) -> int:
+    # Sends requests one after another, returning how many came back as errors
+    reader, writer = await connect(args)
+    errors = 0
+    request = {"source": source}
+    if args.fuel is not None:
+        request["fuel"] = args.fuel
+    line = json.dumps(request).encode() + b"\n"
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        writer.write(line)
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - start)
+        errors += "error" in response
+    writer.close()
+    await writer.wait_closed()
+    return errors
+
+
+async def load(args: argparse.Namespace) -> None:
+    source = "1 + 2" if args.path is None else open(args.path, "r").read()
+    latencies: list[float] = []
+    start = time.perf_counter()
+    errors = await asyncio.gather(
+        *(client(args, source, latencies) for _ in range(args.connections))
+    )
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(
+        f"{len(latencies)} requests over {args.connections} connections "
+        f"in {elapsed:.2f} s: {len(latencies) / elapsed:.0f} requests/s, "
+        f"{sum(errors)} errors"
+    )
+    for percentile in [50, 90, 99, 100]:
+        index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+        print(f"p{percentile: <3} {latencies[index] * 1000:9.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="server", description="Evaluates programs sent over a socket"
+    )
+    commands = parser.add_subparsers(
+        required=True, help="Run the server, or a client to load it", dest="command"
+    )
+    serve_parser = commands.add_parser("serve")
+    serve_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="How many worker processes to run (default: the number of CPUs)",
+    )
+    serve_parser.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=f"Seconds a request may take unless it asks otherwise "
+        f"(default: {DEFAULT_TIMEOUT})",
+    )
+    serve_parser.add_argument(
+        "--max-depth",
+        type=int,
+        help="How many function calls a program may have in progress at once",
+    )
+    serve_parser.add_argument(
+        "--max-int-bits",
+        type=int,
+        default=DEFAULT_INT_BITS,
+        help="How many bits the integers a program makes may have "
+        f"(default: {DEFAULT_INT_BITS})",
+    )
+    serve_parser.set_defaults(run=serve)
+
+    load_parser = commands.add_parser("load")
+    load_parser.add_argument(
+        "path", nargs="?", help="The program to send (default: `1 + 2`)"
+    )
+    load_parser.add_argument("--connections", type=int, default=8)
+    load_parser.add_argument(
+        "--requests", type=int, default=200, help="How many to send per connection"
+    )
+    load_parser.set_defaults(run=load)
+
+    for command_parser in [serve_parser, load_parser]:
+        command_parser.add_argument("--socket", metavar="PATH", help="A Unix socket")
+        command_parser.add_argument("--host", default="127.0.0.1")
+        command_parser.add_argument("--port", type=int, default=7878)
+        command_parser.add_argument(
+            "--fuel", type=int, help="How many function calls a program may make"
+        )
+
+    args = parser.parse_args()
+    try:
+        asyncio.run(args.run(args))
+    except KeyboardInterrupt:
+        pass
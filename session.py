@@ -0,0 +1,123 @@
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import cache
+import cek
+import closure
+import vm
+from expr import Expr, RawLetBind
+from interpret import Env, Frame, Interpret, Value
+from parser import Parser
+from resolve import Scope, resolve
+from tracing import Tracer, TracingInterpret
+
+
+@dataclass
+class Timings:
+    lex: float
+    parse: float
+    eval: float
+    cached: bool
+
+    def __str__(self) -> str:
+        if self.cached:
+            front = "lex + parse: cached"
+        else:
+            front = f"lex: {self.lex * 1000:.3f} ms, parse: {self.parse * 1000:.3f} ms"
+        return f"{front}, eval: {self.eval * 1000:.3f} ms"
+
+
+class Session:
+    """
+    The state of a REPL session: top-level definitions (a `let` without an `in`) persist
+    between lines, so each line only parses and evaluates the new input
+
+    Note: Definitions are kept both in `env`, for the engines that look names up in an `Env`,
+    and in `frame` at the slots in `globals`, for the ones that run resolved programs
+    """
+
+    engine: str
+    parse_cache: Optional[cache.ParseCache]
+    # Only used by the interpret engine
+    tracer: Optional[Tracer]
+    env: Env
+    frame: Frame
+    globals: Scope
+    # For the last line run
+    timings: Optional[Timings]
+
+    def __init__(
+        self,
+        engine: str = "interpret",
+        parse_cache: Optional[cache.ParseCache] = None,
+        tracer: Optional[Tracer] = None,
+    ) -> None:
+        self.engine = engine
+        self.parse_cache = parse_cache
+        self.tracer = tracer
+        self.env = Env()
+        self.frame = [None]
+        self.globals = {}
+        self.timings = None
+
+    def parse(self, source: str) -> cache.Parsed:
+        self.timings = Timings(lex=0, parse=0, eval=0, cached=False)
+        if self.parse_cache is not None:
+            key = cache.line_key(source)
+            if (parsed := self.parse_cache.get(key)) is not None:
+                self.timings.cached = True
+                return parsed
+
+        # The compact parser lexes everything up front, so lexing can be timed on its own
+        start = time.perf_counter()
+        parser = Parser(source, compact=True)
+        lexed = time.perf_counter()
+        parsed = parser.parse_line()
+        self.timings.lex = lexed - start
+        self.timings.parse = time.perf_counter() - lexed
+
+        if self.parse_cache is not None:
+            self.parse_cache.put(key, parsed)
+        return parsed
+
+    def define(self, bindings: list[RawLetBind]) -> list[tuple[str, Value]]:
+        # Nothing is defined unless every binding evaluates
+        env, globals, size = self.env, self.globals, len(self.frame)
+        self.globals = dict(globals)
+        defined = []
+        try:
+            for bind in bindings:
+                value = self.evaluate(bind.value)
+                self.env = self.env.extend(bind.name, value)
+                self.frame.append(value)
+                self.globals[bind.name.data] = len(self.frame) - 1
+                defined.append((bind.name.data, value))
+        except Exception:
+            self.env, self.globals = env, globals
+            del self.frame[size:]
+            raise
+
+        return defined
+
+    def evaluate(self, expr: Expr) -> Value:
+        start = time.perf_counter()
+        try:
+            match self.engine:
+                case "interpret" if self.tracer is not None:
+                    return TracingInterpret(self.env, self.tracer).interpret(expr)
+                case "interpret":
+                    return Interpret(self.env).interpret(expr)
+                case "cek":
+                    return cek.Machine().run(expr, self.env)
+                case "closure":
+                    code = closure.Compiler().compile(resolve(expr, self.globals))
+                    return code(self.frame)
+                case "vm":
+                    chunk = vm.compile_program(expr, self.globals)
+                    return vm.execute(chunk, self.frame)
+        finally:
+            if self.timings is not None:
+                self.timings.eval += time.perf_counter() - start
+
+        assert False, "unreachable"
@@ -0,0 +1,80 @@
+from pprint import pprint
+from typing import Optional
+
+from expr import Expr, Fun
+from interpret import Env, FunValue, Interpret, Value
+from utils import Span, Spanned
+
+
+class Tracer:
+    """
+    Hooks that `TracingInterpret` calls as it evaluates, which all do nothing here. Subclasses
+    override the ones they care about
+
+    Note: When evaluation raises, `exit` and `ret` aren't called for the nodes and calls that
+    were unwound
+    """
+
+    def enter(self, expr: Expr, env: Env) -> None:
+        pass
+
+    def exit(self, expr: Expr, value: Value) -> None:
+        pass
+
+    def fun(self, span: Span, value: FunValue, frame: Env) -> None:
+        # `frame` is the environment the innermost call started from (or evaluation did, at
+        # the top level), so `value.captures.names(frame)` is what the call has bound
+        pass
+
+    def call(self, f: FunValue, arg: Value) -> None:
+        pass
+
+    def ret(self, f: FunValue, result: Value) -> None:
+        pass
+
+
+class DebugTracer(Tracer):
+    # The output `Interpret.fun` used to print every time it made a closure
+    def fun(self, span: Span, value: FunValue, frame: Env) -> None:
+        print(f"\n{str(Fun(value.param, value.body, span.start, span.end))}")
+        # Only the innermost frame, which is all the old dict-per-frame `Env` printed
+        pprint(value.captures.names(frame))
+
+
+class TracingInterpret(Interpret):
+    """
+    An `Interpret` that reports what it's doing to a `Tracer`
+
+    Note: Hooks live in this subclass rather than behind checks in `Interpret`, so evaluating
+    without tracing costs exactly what it did before
+    """
+
+    tracer: Tracer
+    # Where the innermost call's environment starts, see `Tracer.fun`
+    frame: Env
+
+    def __init__(self, env: Optional[Env], tracer: Tracer) -> None:
+        super().__init__(env)
+        self.tracer = tracer
+        self.frame = self.env
+
+    def interpret(self, expr: Expr) -> Value:
+        self.tracer.enter(expr, self.env)
+        value = super().interpret(expr)
+        self.tracer.exit(expr, value)
+        return value
+
+    def fun(self, span: Span, param: Spanned[str], body: Expr) -> Value:
+        value = super().fun(span, param, body)
+        assert isinstance(value, FunValue)
+        self.tracer.fun(span, value, self.frame)
+        return value
+
+    def call(self, f: FunValue, arg: Value) -> Value:
+        self.tracer.call(f, arg)
+        previous = self.frame
+        self.frame = f.captures  # type: ignore
+        result = super().call(f, arg)
+        self.frame = previous
+        self.tracer.ret(f, result)
+        return result
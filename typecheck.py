@@ -0,0 +1,266 @@
+import operator
+from dataclasses import dataclass
+from itertools import count
+from typing import Any, Callable, Generator, Optional
+
+from expr import App, BinOp, Expr, Fun, Ident, IntLit, LetIn, Negate, Op, Print
+from interpret import Interpret, NotBound, Ty, TypeMismatch, Value
+from utils import Span, Spanned, trampoline
+
+
+class Type:
+    __slots__ = ()
+
+
+class IntType(Type):
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        return "int"
+
+
+INT = IntType()
+
+
+@dataclass(slots=True)
+class FunType(Type):
+    param: Type
+    result: Type
+
+    def __str__(self) -> str:
+        param = prune(self.param)
+        if isinstance(param, FunType):
+            return f"({param}) -> {prune(self.result)}"
+        return f"{param} -> {prune(self.result)}"
+
+
+@dataclass(slots=True, eq=False)
+class TypeVar(Type):
+    id: int
+    # How many `let`s deep it was made, it's only generalised by a `let` deeper than that
+    level: int
+    # What it's been unified with, if anything
+    ref: Optional[Type] = None
+
+    def __str__(self) -> str:
+        return f"t{self.id}" if self.ref is None else str(prune(self.ref))
+
+
+@dataclass(slots=True)
+class Scheme:
+    # A type that's polymorphic in `vars`, each instantiated afresh wherever it's used
+    vars: list[TypeVar]
+    type: Type
+
+
+@dataclass
+class InfiniteType(Exception):
+    # Like `fun x => x x`, which can't be given a type without one containing itself
+    span: Span
+
+
+class Clash(Exception):
+    # Raised by `unify`, and turned into a `TypeMismatch` at the node it happened for
+    expected: Ty
+    got: Ty
+
+    def __init__(self, expected: Type, got: Type) -> None:
+        self.expected = ty(expected)
+        self.got = ty(got)
+
+
+class Occurs(Exception):
+    pass
+
+
+# Run by `trampoline`, so deep programs and types don't overflow the Python stack
+Steps = Generator["Steps", Any, Type]
+
+
+def ty(type: Type) -> Ty:
+    return Ty.TY_INT if isinstance(type, IntType) else Ty.TY_FUN
+
+
+def prune(type: Type) -> Type:
+    # Follows `TypeVar`s to what they've been unified with, shortening the path as it goes
+    while isinstance(type, TypeVar) and type.ref is not None:
+        if isinstance(type.ref, TypeVar) and type.ref.ref is not None:
+            type.ref = type.ref.ref
+        type = type.ref
+    return type
+
+
+class Inferrer:
+    """
+    Hindley-Milner type inference, with `let`-bound names generalised so `add`, `cmp` and the
+    like can be used at more than one type
+
+    Note: Type variables are generalised by level (how many `let`s deep they were made) rather
+    than by scanning the environment, and unified by mutating them in place
+    """
+
+    names: count
+    level: int
+
+    def __init__(self) -> None:
+        self.names = count()
+        self.level = 0
+
+    def fresh(self) -> TypeVar:
+        return TypeVar(next(self.names), self.level)
+
+    def infer(self, expr: Expr, env: dict[str, Scheme]) -> Type:
+        return trampoline(self.infer_steps(expr, env))
+
+    def infer_steps(self, expr: Expr, env: dict[str, Scheme]) -> Steps:
+        match expr:
+            case LetIn(bindings, body):
+                env = dict(env)
+                for bind in bindings:
+                    self.level += 1
+                    value = yield self.infer_steps(bind.value, env)
+                    self.level -= 1
+                    env[bind.name.data] = self.generalise(value)
+                return (yield self.infer_steps(body, env))
+            case Fun(param, body):
+                param_type = self.fresh()
+                env = env | {param.data: Scheme([], param_type)}
+                return FunType(param_type, (yield self.infer_steps(body, env)))
+            case App(f, arg):
+                f_type = yield self.infer_steps(f, env)
+                arg_type = yield self.infer_steps(arg, env)
+                match prune(f_type):
+                    case FunType(param, result):
+                        self.unify(param, arg_type, arg.span)
+                        return result
+                    case IntType():
+                        raise TypeMismatch(f.span, Ty.TY_FUN, Ty.TY_INT)
+                result = self.fresh()
+                self.unify(f_type, FunType(arg_type, result), f.span)
+                return result
+            case BinOp(_, lhs, rhs):
+                self.unify(INT, (yield self.infer_steps(lhs, env)), lhs.span)
+                self.unify(INT, (yield self.infer_steps(rhs, env)), rhs.span)
+                return INT
+            case Negate(operand):
+                self.unify(INT, (yield self.infer_steps(operand, env)), operand.span)
+                return INT
+            case Print(value):
+                return (yield self.infer_steps(value, env))
+            case Ident(ident):
+                scheme = env.get(ident)
+                if scheme is None:
+                    raise NotBound(expr.span)
+                return self.instantiate(scheme)
+            case IntLit(_):
+                return INT
+
+        assert False, "unreachable"
+
+    def unify(self, expected: Type, got: Type, span: Span) -> None:
+        if expected is got:
+            return
+        try:
+            self.unify_types(expected, got)
+        except Clash as clash:
+            raise TypeMismatch(span, clash.expected, clash.got)
+        except Occurs:
+            raise InfiniteType(span)
+
+    def unify_types(self, expected: Type, got: Type) -> None:
+        # In the order recursion would take, params before results
+        pending = [(expected, got)]
+        while pending:
+            expected, got = pending.pop()
+            expected, got = prune(expected), prune(got)
+            if expected is got:
+                continue
+            if isinstance(expected, TypeVar):
+                self.bind(expected, got)
+            elif isinstance(got, TypeVar):
+                self.bind(got, expected)
+            elif isinstance(expected, FunType) and isinstance(got, FunType):
+                pending.append((expected.result, got.result))
+                pending.append((expected.param, got.param))
+            elif type(expected) is not type(got):
+                raise Clash(expected, got)
+
+    def bind(self, var: TypeVar, type: Type) -> None:
+        # Anything in `type` can now only be generalised where `var` could be
+        pending = [type]
+        while pending:
+            part = prune(pending.pop())
+            if part is var:
+                raise Occurs()
+            match part:
+                case TypeVar():
+                    part.level = min(part.level, var.level)
+                case FunType(param, result):
+                    pending.extend([param, result])
+        var.ref = type
+
+    def generalise(self, type: Type) -> Scheme:
+        vars: dict[int, TypeVar] = {}
+        pending = [type]
+        while pending:
+            part = prune(pending.pop())
+            match part:
+                case TypeVar() if part.level > self.level:
+                    vars[part.id] = part
+                case FunType(param, result):
+                    pending.extend([param, result])
+        return Scheme(list(vars.values()), type)
+
+    def instantiate(self, scheme: Scheme) -> Type:
+        if not scheme.vars:
+            return scheme.type
+        fresh = {var.id: self.fresh() for var in scheme.vars}
+
+        def copy(type: Type) -> Steps:
+            type = prune(type)
+            match type:
+                case TypeVar():
+                    return fresh.get(type.id, type)
+                case FunType(param, result):
+                    return FunType((yield copy(param)), (yield copy(result)))
+            return type
+
+        return trampoline(copy(scheme.type))
+
+
+def infer(expr: Expr) -> Type:
+    """
+    The type of `expr`, or a `TypeMismatch`, `InfiniteType` or `NotBound` for where it goes
+    wrong
+    """
+
+    return Inferrer().infer(expr, {})
+
+
+OPERATORS: dict[Op, Callable[[int, int], int]] = {
+    Op.OP_ADD: operator.add,
+    Op.OP_SUB: operator.sub,
+    Op.OP_MUL: operator.mul,
+    Op.OP_DIV: operator.floordiv,
+    Op.OP_MOD: operator.mod,
+}
+
+
+class UncheckedInterpret(Interpret):
+    """
+    An `Interpret` without the checks for applying an integer or doing arithmetic on a
+    function, for programs that `infer` has already shown can't do either
+
+    Note: Running a program that doesn't type-check with this is undefined behaviour, in that
+    it raises whatever Python does
+    """
+
+    def app(self, f: Expr, arg: Expr) -> Value:
+        f_value = self.interpret(f)
+        return self.call(f_value, self.interpret(arg))  # type: ignore
+
+    def negate(self, span: Span, expr: Expr) -> Value:
+        return -self.interpret(expr)  # type: ignore
+
+    def bin_op(self, span: Span, op: Spanned[Op], lhs: Expr, rhs: Expr) -> Value:
+        return OPERATORS[op.data](self.interpret(lhs), self.interpret(rhs))  # type: ignore
@@ -1,8 +1,17 @@
 from dataclasses import dataclass
-from typing import Callable, Generic, Iterator, NoReturn, Optional, TypeVar
-
-
-@dataclass
+from typing import (
+    Any,
+    Callable,
+    Generator,
+    Generic,
+    Iterator,
+    NoReturn,
+    Optional,
+    TypeVar,
+)
+
+
+@dataclass(slots=True)
 class Span:
     start: int
     end: int
@@ -60,7 +69,7 @@ class Peekable(Generic[T]):
 U = TypeVar("U")
 
 
-@dataclass
+@dataclass(slots=True)
 class Spanned(Generic[U]):
     span: Span
     data: U
@@ -86,3 +95,27 @@ def map_pred(opt: Optional[W], f: Callable[[W], bool]) -> bool:
 
 def stop_iteration() -> NoReturn:
     raise StopIteration
+
+
+X = TypeVar("X")
+
+
+def trampoline(steps: Generator[Any, Any, X]) -> X:
+    """
+    Runs generators that yield a generator wherever they'd otherwise recurse, sending each
+    one the value the generator it yielded returned, with a list for a stack
+    """
+
+    stack = [steps]
+    result = None
+    while stack:
+        try:
+            step = stack[-1].send(result)
+        except StopIteration as stop:
+            stack.pop()
+            result = stop.value
+        else:
+            stack.append(step)
+            result = None
+
+    return result  # type: ignore
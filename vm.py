@@ -0,0 +1,322 @@
+from array import array
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Generator, Optional
+
+from expr import (
+    App,
+    BinOp,
+    Expr,
+    Fun,
+    Ident,
+    IntLit,
+    LetIn,
+    Negate,
+    Op,
+    Print,
+    RawLetBind,
+)
+from interpret import Frame, FunValue, Ty, TypeMismatch, Value
+from resolve import Scope, resolve
+from utils import Span, Spanned, trampoline
+
+
+class OpCode(IntEnum):
+    # Operands are listed in brackets, each one is a single 32-bit word
+    CONST = 0  # [index]      push consts[index]
+    LOAD0 = 1  # [slot]       push frame[slot]
+    LOAD1 = 2  # [slot]       push frame[0][slot]
+    LOAD = 3  # [depth, slot] push the slot `depth` frames out
+    ENTER = 4  # [size]       push a new frame with `size` slots
+    STORE = 5  # [slot]       pop into frame[slot]
+    LEAVE = 6  #              pop the current frame
+    CLOSURE = 7  # [index]    push a function capturing the current frame
+    CALL = 8  #               pop an argument and a function and call it
+    RETURN = 9  #             return the top of the stack to the caller
+    NEGATE = 10
+    ADD = 11
+    SUB = 12
+    MUL = 13
+    DIV = 14
+    MOD = 15
+    PRINT = 16  #             print the top of the stack, leaving it there
+
+
+# Plain ints for the dispatch loop in `execute`,
+# comparing against enum members is a lot slower
+OP_CONST = int(OpCode.CONST)
+OP_LOAD0 = int(OpCode.LOAD0)
+OP_LOAD1 = int(OpCode.LOAD1)
+OP_LOAD = int(OpCode.LOAD)
+OP_ENTER = int(OpCode.ENTER)
+OP_STORE = int(OpCode.STORE)
+OP_LEAVE = int(OpCode.LEAVE)
+OP_CLOSURE = int(OpCode.CLOSURE)
+OP_CALL = int(OpCode.CALL)
+OP_RETURN = int(OpCode.RETURN)
+OP_NEGATE = int(OpCode.NEGATE)
+OP_ADD = int(OpCode.ADD)
+OP_SUB = int(OpCode.SUB)
+OP_MUL = int(OpCode.MUL)
+OP_DIV = int(OpCode.DIV)
+OP_MOD = int(OpCode.MOD)
+OP_PRINT = int(OpCode.PRINT)
+
+OPERAND_COUNTS = {
+    OpCode.CONST: 1,
+    OpCode.LOAD0: 1,
+    OpCode.LOAD1: 1,
+    OpCode.LOAD: 2,
+    OpCode.ENTER: 1,
+    OpCode.STORE: 1,
+    OpCode.CLOSURE: 1,
+}
+
+BINOP_OPCODES = {
+    Op.OP_ADD: OpCode.ADD,
+    Op.OP_SUB: OpCode.SUB,
+    Op.OP_MUL: OpCode.MUL,
+    Op.OP_DIV: OpCode.DIV,
+    Op.OP_MOD: OpCode.MOD,
+}
+
+
+@dataclass
+class Chunk:
+    """
+    The bytecode for a single function body (or the whole program), with its own constant pool
+
+    Note: `spans` maps the offset of any instruction that can fail to the spans `Interpret` would
+    report for it
+    """
+
+    name: str
+    code: array = field(default_factory=lambda: array("I"))
+    consts: list["Value | Chunk"] = field(default_factory=list)
+    spans: dict[int, tuple[Span, ...]] = field(default_factory=dict)
+    param: "Spanned[str] | None" = None
+    body: "Expr | None" = None
+    int_consts: dict[int, int] = field(default_factory=dict, repr=False)
+
+    def emit(self, op: OpCode, *operands: int) -> int:
+        offset = len(self.code)
+        self.code.append(op)
+        self.code.extend(operands)
+        return offset
+
+    def add_const(self, value: "Value | Chunk") -> int:
+        # Integer literals are deduplicated, function bodies are always distinct
+        if type(value) is int and value in self.int_consts:
+            return self.int_consts[value]
+        self.consts.append(value)
+        if type(value) is int:
+            self.int_consts[value] = len(self.consts) - 1
+        return len(self.consts) - 1
+
+
+# Run by `trampoline`, so compiling deeply nested programs doesn't overflow the Python stack
+Steps = Generator["Steps", Any, None]
+
+
+class Compiler:
+    chunk: Chunk
+
+    def __init__(self, chunk: Chunk) -> None:
+        self.chunk = chunk
+
+    def compile(self, expr: Expr) -> None:
+        trampoline(self.compile_steps(expr))
+
+    def compile_steps(self, expr: Expr) -> Steps:
+        match expr.data:
+            case LetIn(bindings, body):
+                yield self.let_in(bindings, body)
+            case Fun(param, body):
+                yield self.fun(param, body)
+            case App(f, arg):
+                yield self.compile_steps(f)
+                yield self.compile_steps(arg)
+                offset = self.chunk.emit(OpCode.CALL)
+                self.chunk.spans[offset] = (f.span,)
+            case Negate(operand):
+                yield self.compile_steps(operand)
+                # `Interpret` reports the operand's span here, so we do too
+                offset = self.chunk.emit(OpCode.NEGATE)
+                self.chunk.spans[offset] = (operand.span,)
+            case BinOp(op, lhs, rhs):
+                yield self.compile_steps(lhs)
+                yield self.compile_steps(rhs)
+                offset = self.chunk.emit(BINOP_OPCODES[op.data])
+                self.chunk.spans[offset] = (expr.span, lhs.span, rhs.span)
+            case Print(value):
+                yield self.compile_steps(value)
+                self.chunk.emit(OpCode.PRINT)
+            case Ident(_) as ident:
+                self.ident(ident)
+            case IntLit(num):
+                self.chunk.emit(OpCode.CONST, self.chunk.add_const(num))
+            case _:
+                assert False, "unreachable"
+
+    def let_in(self, bindings: list[RawLetBind], body: Expr) -> Steps:
+        self.chunk.emit(OpCode.ENTER, len(bindings))
+        for bind in bindings:
+            assert bind.slot is not None, "unresolved binding"
+            yield self.compile_steps(bind.value)
+            self.chunk.emit(OpCode.STORE, bind.slot)
+        yield self.compile_steps(body)
+        self.chunk.emit(OpCode.LEAVE)
+
+    def fun(self, param: Spanned[str], body: Expr) -> Steps:
+        chunk = Chunk(name=param.data, param=param, body=body)
+        yield Compiler(chunk).compile_steps(body)
+        chunk.emit(OpCode.RETURN)
+        self.chunk.emit(OpCode.CLOSURE, self.chunk.add_const(chunk))
+
+    def ident(self, ident: Ident) -> None:
+        depth, slot = ident.depth, ident.slot
+        assert depth is not None and slot is not None, "unresolved identifier"
+
+        match depth:
+            case 0:
+                self.chunk.emit(OpCode.LOAD0, slot)
+            case 1:
+                self.chunk.emit(OpCode.LOAD1, slot)
+            case _:
+                self.chunk.emit(OpCode.LOAD, depth, slot)
+
+
+def compile_program(expr: Expr, globals: Optional[Scope] = None) -> Chunk:
+    chunk = Chunk(name="<program>")
+    Compiler(chunk).compile(resolve(expr, globals))
+    chunk.emit(OpCode.RETURN)
+    return chunk
+
+
+def int_operands(spans: tuple[Span, ...], x: Value, y: Value) -> None:
+    # Mirrors the error spans of `Interpret.bin_op`
+    span, lhs_span, rhs_span = spans
+    if type(x) is FunValue:
+        got_span = span if type(y) is FunValue else lhs_span
+        raise TypeMismatch(span=got_span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+    elif type(y) is FunValue:
+        raise TypeMismatch(span=rhs_span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+
+
+def execute(chunk: Chunk, frame: Frame) -> Value:
+    # Calls don't recurse on the Python stack, they push onto `calls` instead
+    calls: list[tuple[Chunk, int, Frame]] = []
+    stack: list[Value] = []
+    push = stack.append
+    pop = stack.pop
+    code = chunk.code
+    consts = chunk.consts
+    pc = 0
+
+    while True:
+        op = code[pc]
+        if op == OP_LOAD0:
+            push(frame[code[pc + 1]])
+            pc += 2
+        elif op == OP_LOAD1:
+            push(frame[0][code[pc + 1]])
+            pc += 2
+        elif op == OP_CONST:
+            push(consts[code[pc + 1]])
+            pc += 2
+        elif op == OP_CALL:
+            arg = pop()
+            f = pop()
+            if type(f) is not FunValue:
+                (f_span,) = chunk.spans[pc]
+                raise TypeMismatch(span=f_span, expected=Ty.TY_FUN, got=Ty.TY_INT)
+            calls.append((chunk, pc + 1, frame))
+            chunk = f.code
+            code = chunk.code
+            consts = chunk.consts
+            frame = [f.captures, arg]
+            pc = 0
+        elif op == OP_RETURN:
+            if not calls:
+                return pop()
+            chunk, pc, frame = calls.pop()
+            code = chunk.code
+            consts = chunk.consts
+        elif op == OP_CLOSURE:
+            body = consts[code[pc + 1]]
+            push(FunValue(param=body.param, captures=frame, body=body.body, code=body))
+            pc += 2
+        elif op == OP_LOAD:
+            target = frame
+            for _ in range(code[pc + 1]):
+                target = target[0]
+            push(target[code[pc + 2]])
+            pc += 3
+        elif OP_ADD <= op <= OP_MOD:
+            y = pop()
+            x = pop()
+            if type(x) is FunValue or type(y) is FunValue:
+                int_operands(chunk.spans[pc], x, y)
+            if op == OP_ADD:
+                push(x + y)
+            elif op == OP_SUB:
+                push(x - y)
+            elif op == OP_MUL:
+                push(x * y)
+            elif op == OP_DIV:
+                push(x // y)
+            else:
+                push(x % y)
+            pc += 1
+        elif op == OP_ENTER:
+            frame = [frame, *([None] * code[pc + 1])]
+            pc += 2
+        elif op == OP_STORE:
+            frame[code[pc + 1]] = pop()
+            pc += 2
+        elif op == OP_LEAVE:
+            frame = frame[0]
+            pc += 1
+        elif op == OP_NEGATE:
+            value = pop()
+            if type(value) is FunValue:
+                (span,) = chunk.spans[pc]
+                raise TypeMismatch(span=span, expected=Ty.TY_INT, got=Ty.TY_FUN)
+            push(-value)
+            pc += 1
+        elif op == OP_PRINT:
+            value = stack[-1]
+            print("<function value>" if type(value) is FunValue else value)
+            pc += 1
+        else:
+            assert False, "unreachable"
+
+
+def evaluate(expr: Expr) -> Value:
+    return execute(compile_program(expr), [None])
+
+
+def disassemble(chunk: Chunk) -> str:
+    lines = [f"== {chunk.name} =="]
+    nested: list[Chunk] = []
+    pc = 0
+    while pc < len(chunk.code):
+        op = OpCode(chunk.code[pc])
+        operands = chunk.code[pc + 1 : pc + 1 + OPERAND_COUNTS.get(op, 0)]
+        line = f"{pc:04} {op.name: <8} {' '.join(map(str, operands)): <6}"
+
+        match op:
+            case OpCode.CONST:
+                line += f" ; {chunk.consts[operands[0]]}"
+            case OpCode.CLOSURE:
+                body = chunk.consts[operands[0]]
+                assert isinstance(body, Chunk)
+                nested.append(body)
+                line += f" ; <fun {body.name}>"
+            case _ if pc in chunk.spans:
+                line += f" ; @ {', '.join(map(str, chunk.spans[pc]))}"
+
+        lines.append(line.rstrip())
+        pc += 1 + len(operands)
+
+    return "\n".join([*lines, *(f"\n{disassemble(body)}" for body in nested)])